@@ -0,0 +1,125 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+
+class Rejected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> bool:
+        self._refill()
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _BucketSet:
+    def __init__(self, per_minute: float, burst: int, max_keys: int = 10000):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def get(self, key) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+
+class AdmissionController:
+    """Token buckets per user, channel and guild in front of a bounded wait queue for in-flight work"""
+
+    def __init__(self, limits: dict, max_inflight: int = 32, max_queue: int = 64, max_wait: float = 20.0, shared=None):
+        # limits: scope -> (per_minute, burst) for "user", "channel" and "guild"
+        self.scopes = {scope: _BucketSet(per_minute, burst) for scope, (per_minute, burst) in limits.items()}
+        # with a SharedBackend the buckets live there, so limits hold across processes
+        self.shared = shared
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.semaphore = asyncio.Semaphore(max_inflight)
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejections = {"rate_limited": 0, "queue_full": 0, "timeout": 0}
+
+    async def _check_rate(self, keys: dict):
+        if self.shared:
+            shared_buckets = [
+                (f"rate:{scope}:{key}", self.scopes[scope].rate, self.scopes[scope].burst)
+                for scope, key in keys.items() if scope in self.scopes
+            ]
+            try:
+                allowed = await self.shared.take_tokens(shared_buckets)
+            except Exception as e:
+                print(f"Shared rate limit error, using local buckets: {e}")
+            else:
+                if not allowed:
+                    self._reject("rate_limited")
+                return
+
+        buckets = [self.scopes[scope].get(key) for scope, key in keys.items() if scope in self.scopes]
+        # only spend tokens when every scope has one, a rejected message shouldn't drain the others
+        if not all(bucket.available() for bucket in buckets):
+            self._reject("rate_limited")
+        for bucket in buckets:
+            bucket.take()
+
+    def _reject(self, reason: str):
+        self.rejections[reason] += 1
+        raise Rejected(reason)
+
+    @asynccontextmanager
+    async def admit(self, user_id, channel_id, guild_id):
+        await self._check_rate({"user": user_id, "channel": channel_id, "guild": guild_id})
+
+        if self.semaphore.locked():
+            if self.waiting >= self.max_queue:
+                self._reject("queue_full")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                self._reject("timeout")
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+
+        self.inflight += 1
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self.semaphore.release()
+
+    def stats(self):
+        return {
+            "inflight": self.inflight,
+            "queue_depth": self.waiting,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejections),
+        }
@@ -0,0 +1,479 @@
+"""Offline benchmark for the message and slash command paths.
+
+Drives chatbot.on_message (in channels and in threads with chat sessions), DiscordService.send_response and the /image and /search callbacks against
+an in-process fake Discord layer and a fake genai client, then reports throughput, p50/p99 latency and
+event loop blocking per concurrency level. No network access or tokens are needed.
+
+    python benchmark.py
+    python benchmark.py --concurrency 1,16,64 --operations 500 --latency 0.2 --payload-chars 4000
+    python benchmark.py --scenarios message,vision --json > before.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import discord
+
+# chatbot reads its configuration at import time
+BENCH_ENV = {
+    "DISCORD_TOKEN": "bench",
+    "GOOGLE_API_KEY": "bench",
+    "GUILD_ID": "1",
+    "CHANNEL_ID": "100",
+    "USER_RATE_PER_MIN": "1000000",
+    "USER_BURST": "1000000",
+    "CHANNEL_RATE_PER_MIN": "1000000",
+    "CHANNEL_BURST": "1000000",
+    "GUILD_RATE_PER_MIN": "1000000",
+    "GUILD_BURST": "1000000",
+    "MAX_INFLIGHT": "1024",
+    "MAX_QUEUE": "4096",
+    "DEBOUNCE_SECONDS": "0",
+    "STORAGE_BACKEND": "json",
+}
+
+SCENARIOS = ("message", "vision", "thread", "send", "image", "search")
+
+_ids = itertools.count(1_000_000)
+
+
+# fake genai
+
+class FakeAPIError(Exception):
+    """Stands in for genai's errors.APIError, which carries the HTTP status as .code"""
+
+    def __init__(self, code: int):
+        super().__init__(f"{code} UNAVAILABLE")
+        self.code = code
+
+
+class FakeModels:
+    def __init__(self, latency: float, jitter: float, payload_chars: int, image_bytes: bytes, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.payload_chars = payload_chars
+        self.image_bytes = image_bytes
+        self.calls = 0
+        self.prompt_chars = 0
+
+    async def _wait(self, contents):
+        self.calls += 1
+        self.prompt_chars += sum(
+            len(part.text or "") for content in contents if not isinstance(content, str) for part in content.parts
+        ) + sum(len(content) for content in contents if isinstance(content, str))
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        if random.random() < self.error_rate:
+            raise FakeAPIError(503)
+
+    def _text(self):
+        words = itertools.cycle("lorem ipsum dolor sit amet consectetur adipiscing elit".split())
+        text = ""
+        while len(text) < self.payload_chars:
+            text += next(words) + (" " if random.random() > 0.1 else "\n")
+        return text[:self.payload_chars]
+
+    @staticmethod
+    def _usage(text):
+        return SimpleNamespace(prompt_token_count=len(text) // 4, candidates_token_count=len(text) // 4,
+                               cached_content_token_count=None)
+
+    async def generate_content(self, model, contents, config=None):
+        await self._wait(contents)
+        text = self._text()
+        parts = [SimpleNamespace(text=text, inline_data=None)]
+        if config is not None and "IMAGE" in (getattr(config, "response_modalities", None) or []):
+            parts.append(SimpleNamespace(text=None, inline_data=SimpleNamespace(mime_type="image/png", data=self.image_bytes)))
+        return SimpleNamespace(
+            text=text,
+            candidates=[SimpleNamespace(content=SimpleNamespace(parts=parts))],
+            usage_metadata=self._usage(text),
+        )
+
+    async def generate_content_stream(self, model, contents, config=None):
+        await self._wait(contents)
+        text = self._text()
+
+        async def chunks():
+            step = max(1, len(text) // 10)
+            for i in range(0, len(text), step):
+                await asyncio.sleep(self.latency / 10)
+                yield SimpleNamespace(text=text[i:i + step], usage_metadata=None)
+            yield SimpleNamespace(text="", usage_metadata=self._usage(text))
+
+        return chunks()
+
+
+class FakeClient:
+    def __init__(self, models: FakeModels):
+        self.aio = SimpleNamespace(models=models)
+
+
+# fake discord
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+
+    def mentioned_in(self, message):
+        return self in message.mentions
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeChannel:
+    def __init__(self, channel_id, send_latency: float, backlog=()):
+        self.id = channel_id
+        self.send_latency = send_latency
+        self.backlog = list(backlog)
+        self.sent = 0
+
+    def typing(self):
+        return FakeTyping()
+
+    async def history(self, limit=100):
+        for message in reversed(self.backlog[-limit:]):
+            yield message
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.send_latency)
+        self.sent += 1
+        return FakeMessage(content or "", BOT_USER, self, None)
+
+    def get_partial_message(self, message_id):
+        return FakeMessage("", BOT_USER, self, None)
+
+
+class FakeThread(FakeChannel, discord.Thread):
+    """Passes isinstance(channel, discord.Thread), FakeChannel's attributes shadow the real ones"""
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel, guild, attachments=(), mentions=()):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.attachments = list(attachments)
+        self.embeds = []
+        self.mentions = list(mentions)
+        self.reference = None
+
+    @property
+    def clean_content(self):
+        return self.content
+
+    async def edit(self, content=None, **kwargs):
+        await asyncio.sleep(self.channel.send_latency)
+        self.content = content
+
+    async def create_thread(self, name, auto_archive_duration=60):
+        await asyncio.sleep(self.channel.send_latency)
+        return FakeThread(next(_ids), self.channel.send_latency)
+
+
+class FakeResponse:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send_message(self, content=None, **kwargs):
+        await self.channel.send(content, **kwargs)
+
+    async def defer(self, **kwargs):
+        pass
+
+
+class FakeInteraction:
+    def __init__(self, user, channel, guild):
+        self.user = user
+        self.channel = channel
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel_id = channel.id
+        self.response = FakeResponse(channel)
+        self.followup = channel
+
+    async def original_response(self):
+        return FakeMessage("", BOT_USER, self.channel, self.guild)
+
+
+BOT_USER = FakeUser(1, "bot", bot=True)
+
+# channels by id for bot.get_channel, and futures resolved when a job for that channel is delivered
+CHANNELS = {}
+DELIVERED = {}
+
+
+# measurement
+
+class LoopMonitor:
+    """Sleeps in a tight interval and records how late each wakeup is, i.e. how long something held the loop"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - started - self.interval))
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def report(self):
+        blocked = [lag for lag in self.lags if lag > 0.001]
+        return {"loop_max_ms": max(self.lags, default=0) * 1000, "loop_blocked_ms": sum(blocked) * 1000}
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def make_png(size: int) -> bytes:
+    from PIL import Image
+
+    image = Image.effect_noise((size, size), 64).convert("RGB")
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+async def start_image_server(png: bytes):
+    """Serves the test image on localhost so the real download path is exercised"""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(body=png, content_type="image/png")
+
+    app = web.Application()
+    app.router.add_get("/{name}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def build_operation(chatbot, scenario, args, guild, users, image_base):
+    """Returns a zero-argument coroutine function running one operation of the scenario"""
+    channel_ids = itertools.count(100)
+    users_cycle = itertools.cycle(users)
+
+    def channel():
+        # the dedicated channel, or a fresh one per op to spread load across dispatcher queues
+        cid = next(channel_ids) if args.spread_channels else 100
+        return FakeChannel(cid, args.send_latency)
+
+    if scenario in ("message", "vision"):
+        async def op():
+            attachments = []
+            if scenario == "vision":
+                # unique url per op so the image cache doesn't turn this into a cache benchmark
+                url = f"{image_base}/{next(_ids)}.png"
+                attachments.append(SimpleNamespace(filename="bench.png", url=url))
+            ch = channel()
+            author = next(users_cycle)
+            message = FakeMessage(f"{BOT_USER.mention} what do you think about this", author, ch, guild, attachments, [BOT_USER])
+            await chatbot.on_message(message)
+        return op
+
+    if scenario == "thread":
+        # one thread per user, so every op is the next turn of a growing conversation
+        threads = {user.id: FakeThread(next(_ids), args.send_latency) for user in users}
+
+        async def op():
+            author = next(users_cycle)
+            ch = threads[author.id]
+            message = FakeMessage(f"{BOT_USER.mention} and what about this", author, ch, guild, (), [BOT_USER])
+            ch.backlog.append(message)
+            await chatbot.on_message(message)
+        return op
+
+    if scenario == "send":
+        text = "word " * (args.payload_chars // 5)
+
+        async def op():
+            ch = channel()
+            message = FakeMessage("hi", next(users_cycle), ch, guild)
+            await chatbot.DiscordService.send_response(message, text)
+        return op
+
+    command = chatbot.generate_image_slash if scenario == "image" else chatbot.slash_search
+    job_channel_ids = itertools.count(10_000_000)
+
+    async def op():
+        # the command returns once the job is queued, time until the result is delivered
+        ch = FakeChannel(next(job_channel_ids), args.send_latency)
+        CHANNELS[ch.id] = ch
+        delivered = DELIVERED[ch.id] = asyncio.get_running_loop().create_future()
+        interaction = FakeInteraction(next(users_cycle), ch, guild)
+        await command.callback(interaction, "a red fox in the snow")
+        await delivered
+        del CHANNELS[ch.id], DELIVERED[ch.id]
+    return op
+
+
+async def run_level(op, concurrency: int, operations: int):
+    latencies = []
+    pending = iter(range(operations))
+    monitor = LoopMonitor()
+
+    async def worker():
+        for _ in pending:
+            started = time.perf_counter()
+            await op()
+            latencies.append(time.perf_counter() - started)
+
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await monitor.stop()
+
+    return {
+        "concurrency": concurrency,
+        "operations": len(latencies),
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        **monitor.report(),
+    }
+
+
+async def main(args):
+    random.seed(args.seed)
+    repo = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo)
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    os.environ.setdefault("STREAM_RESPONSES", "true" if args.stream else "false")
+
+    # prompts.json and friends go to a scratch directory, not the working tree
+    cwd, scratch = os.getcwd(), tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(scratch)
+
+    import chatbot
+
+    png = make_png(args.image_size)
+    models = FakeModels(args.latency, args.jitter, args.payload_chars, png, args.error_rate)
+    chatbot.client = FakeClient(models)
+    chatbot.prompt_manager = chatbot.PromptManager(os.path.join(scratch, "prompts.json"))
+    chatbot.bot._connection.user = BOT_USER
+
+    async def no_commands(message):
+        pass
+    chatbot.bot.process_commands = no_commands
+    chatbot.bot.get_channel = CHANNELS.get
+
+    deliver = chatbot.job_queue.deliver
+
+    async def deliver_and_signal(job, result):
+        try:
+            await deliver(job, result)
+        finally:
+            # the running status update isn't the result
+            if job.status != "running":
+                DELIVERED[job.channel_id].set_result(job.status)
+    chatbot.job_queue.deliver = deliver_and_signal
+
+    guild = SimpleNamespace(id=1)
+    users = [FakeUser(10_000 + i, f"user{i}") for i in range(args.users)]
+    runner, image_base = await start_image_server(png)
+    await chatbot.GeminiService.open_session()
+    await chatbot.job_queue.start()
+
+    results = []
+    try:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                op = build_operation(chatbot, scenario, args, guild, users, image_base)
+                # one untimed op warms the history cache and lazily created pools
+                await op()
+                calls, prompt_chars = models.calls, models.prompt_chars
+                result = await run_level(op, concurrency, args.operations)
+                result.update(scenario=scenario, model_calls=models.calls - calls)
+                result["prompt_chars_per_call"] = (models.prompt_chars - prompt_chars) / max(result["model_calls"], 1)
+                results.append(result)
+                if not args.json:
+                    print(
+                        f"{scenario:<8} c={concurrency:<4} {result['throughput']:8.1f} ops/s  "
+                        f"p50 {result['p50_ms']:8.1f}ms  p99 {result['p99_ms']:8.1f}ms  "
+                        f"loop max {result['loop_max_ms']:6.1f}ms  blocked {result['loop_blocked_ms']:8.1f}ms  "
+                        f"prompt {result['prompt_chars_per_call']:7.0f} chars/call",
+                        flush=True,
+                    )
+    finally:
+        await chatbot.GeminiService.close_session()
+        chatbot.image_pipeline.shutdown()
+        await chatbot.job_queue.close()
+        await chatbot.chat_sessions.close()
+        await runner.cleanup()
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    if args.json:
+        json.dump({"args": vars(args), "results": results}, sys.stdout, indent=2)
+        print()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", type=lambda s: [x for x in s.split(",") if x], default=list(SCENARIOS),
+                        help=f"comma separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=lambda s: [int(x) for x in s.split(",")], default=[1, 8, 32])
+    parser.add_argument("--operations", type=int, default=200, help="operations per concurrency level")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake model latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="standard deviation of the model latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of model calls failing with a retryable 503")
+    parser.add_argument("--payload-chars", type=int, default=800, help="length of generated answers")
+    parser.add_argument("--send-latency", type=float, default=0.005, help="fake Discord REST latency in seconds")
+    parser.add_argument("--image-size", type=int, default=1024, help="edge of the test attachment in pixels")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--spread-channels", action="store_true", help="use a new channel per operation")
+    parser.add_argument("--stream", action="store_true", help="benchmark streamed replies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print machine readable results")
+    args = parser.parse_args(argv)
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,209 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+from lazy_imports import lazy_module
+
+types = lazy_module("google.genai.types")
+
+
+class ChatSession:
+    def __init__(self, thread_id: int, guild_id: int, turns=None, last_message_id: int = 0, updated_at: float = None):
+        self.thread_id = thread_id
+        self.guild_id = guild_id
+        # [{"role": "user" | "model", "text": str}], alternating, oldest first
+        self.turns = turns or []
+        self.last_message_id = last_message_id
+        self.updated_at = updated_at or time.time()
+
+    def append(self, role: str, text: str):
+        if self.turns and self.turns[-1]["role"] == role:
+            # Gemini wants user and model turns to alternate, fold consecutive ones together
+            self.turns[-1]["text"] += "\n" + text
+        else:
+            self.turns.append({"role": role, "text": text})
+
+    def contents(self, user_text: str, image=None):
+        """The stored turns plus the new user turn, as genai Content objects"""
+        contents = [types.Content(role=turn["role"], parts=[types.Part.from_text(text=turn["text"])]) for turn in self.turns]
+        parts = [types.Part.from_text(text=user_text)]
+        if image is not None:
+            parts.append(image)
+        if contents and contents[-1].role == "user":
+            contents[-1].parts.extend(parts)
+        else:
+            contents.append(types.Content(role="user", parts=parts))
+        return contents
+
+    def to_dict(self):
+        return {
+            "thread_id": self.thread_id,
+            "guild_id": self.guild_id,
+            # copies, the dict is serialized off the loop while the session keeps changing
+            "turns": [dict(turn) for turn in self.turns],
+            "last_message_id": self.last_message_id,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["thread_id"], data["guild_id"], data["turns"], data["last_message_id"], data["updated_at"])
+
+
+class ChatSessionStore:
+    """Per-thread multi-turn conversations, bounded in turns and estimated tokens, expired when idle.
+
+    Each reply appends only the new user and model turns. Dirty sessions are flushed debounced
+    to the SQLiteStore, or to sessions.json with the JSON backend, and reloaded on start"""
+
+    def __init__(self, estimate, max_turns: int = 20, token_budget: int = 4000, idle_seconds: int = 6 * 3600,
+                 max_sessions: int = 1000, store=None, path: str = "sessions.json", flush_delay: float = 5.0):
+        self.estimate = estimate
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self.store = store
+        self.path = path
+        self.flush_delay = flush_delay
+        self.sessions: "OrderedDict[int, ChatSession]" = OrderedDict()
+        self._dirty = set()
+        self._removed = set()
+        self._flush_task = None
+
+    def _expired(self, session: ChatSession) -> bool:
+        return time.time() - session.updated_at > self.idle_seconds
+
+    def get(self, thread_id: int):
+        session = self.sessions.get(thread_id)
+        if session is None:
+            return None
+        if self._expired(session):
+            self._drop(thread_id)
+            return None
+        self.sessions.move_to_end(thread_id)
+        return session
+
+    def active(self, thread_id: int) -> bool:
+        return self.get(thread_id) is not None
+
+    def _drop(self, thread_id: int):
+        self.sessions.pop(thread_id, None)
+        self._dirty.discard(thread_id)
+        self._removed.add(thread_id)
+        self.schedule_flush()
+
+    def start(self, thread_id: int, guild_id: int, turns=(), last_message_id: int = 0) -> ChatSession:
+        """New session seeded with (role, text) turns"""
+        session = ChatSession(thread_id, guild_id, last_message_id=last_message_id)
+        for role, text in turns:
+            if text:
+                session.append(role, text)
+        self._trim(session)
+        self.sessions[thread_id] = session
+        self._removed.discard(thread_id)
+        while len(self.sessions) > self.max_sessions:
+            oldest, _ = next(iter(self.sessions.items()))
+            self._drop(oldest)
+        self._touch(session)
+        return session
+
+    def record(self, session: ChatSession, user_text: str, model_text: str, last_message_id: int):
+        session.append("user", user_text)
+        session.append("model", model_text)
+        session.last_message_id = max(session.last_message_id, last_message_id)
+        self._trim(session)
+        self._touch(session)
+
+    def _touch(self, session: ChatSession):
+        session.updated_at = time.time()
+        self._dirty.add(session.thread_id)
+        self.schedule_flush()
+
+    def _trim(self, session: ChatSession):
+        def tokens():
+            return sum(self.estimate(turn["text"]) for turn in session.turns)
+
+        while len(session.turns) > 1 and (len(session.turns) > self.max_turns or tokens() > self.token_budget):
+            session.turns.pop(0)
+            # a conversation has to open with a user turn
+            while session.turns and session.turns[0]["role"] != "user":
+                session.turns.pop(0)
+
+    # persistence
+
+    def _load(self):
+        if self.store:
+            return self.store.load_sessions()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+    async def load(self):
+        records = await asyncio.to_thread(self._load)
+        for record in sorted(records, key=lambda r: r["updated_at"]):
+            session = ChatSession.from_dict(record)
+            if not self._expired(session):
+                self.sessions[session.thread_id] = session
+
+    def _write_file(self, records):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".sessions-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(records, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # changes made while a flush is writing find this task still running, keep going until they're written
+        while True:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+            if not self._dirty and not self._removed:
+                return
+
+    async def flush(self):
+        for thread_id, session in list(self.sessions.items()):
+            if self._expired(session):
+                self._drop(thread_id)
+
+        dirty, self._dirty = self._dirty, set()
+        removed, self._removed = self._removed, set()
+        try:
+            if self.store:
+                snapshot = [self.sessions[tid].to_dict() for tid in dirty if tid in self.sessions]
+                if snapshot or removed:
+                    await asyncio.to_thread(self.store.save_sessions, snapshot, list(removed))
+            elif dirty or removed:
+                await asyncio.to_thread(self._write_file, [session.to_dict() for session in self.sessions.values()])
+        except Exception as e:
+            print(f"Session flush error: {e}")
+            self._dirty |= dirty
+            self._removed |= removed
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "turns": sum(len(session.turns) for session in self.sessions.values()),
+        }
@@ -4,86 +4,336 @@ from discord.ext import commands
 from discord import app_commands
 
 # image management imports
-from PIL import Image
 from io import BytesIO 
 import aiohttp
 
-# Gemini imports
-from google import genai
-from google.genai import types
-from google.genai.types import Tool, GenerateContentConfig, GoogleSearch
+# Gemini imports, deferred until the first request
+from lazy_imports import lazy_module
+genai = lazy_module("google.genai")
+types = lazy_module("google.genai.types")
 
 # general imports
 import os
 import asyncio
 import inspect
 import re
+from functools import lru_cache
 from dotenv import load_dotenv
 import json
 from datetime import datetime
 from typing import Dict, List, Optional
 
+from gemini_scheduler import GeminiScheduler
+from history_cache import ChannelHistoryCache
+from image_pipeline import ImagePipeline
+from image_cache import ImageCache
+from storage import get_store
+from guild_settings import settings
+from dispatcher import OutboundDispatcher
+from context_builder import ContextBuilder
+from summarizer import ChannelSummarizer
+from response_cache import ResponseCache, context_hash, make_key, normalize_prompt
+from prompt_cache import GeminiCachedContentBackend, PromptContextCache
+from admission import AdmissionController, Rejected
+from debouncer import MessageDebouncer
+from command_sync import CommandSyncState, sync_commands
+from shared_state import get_shared_backend
+from cluster import parse_shard_ids
+from job_queue import JobQueue, JobStore
+from chat_sessions import ChatSessionStore
+from model_router import ModelRouter
+from resilience import Resilience, failure_message
+from loop_watchdog import LoopWatchdog, SamplingProfiler, LOOP_LAG, STALLS
+from metrics import registry, span, tracked, record_usage, flatten_stats, start_http_server, STAGE_SECONDS, TOKENS, ERRORS, COMMANDS
+
 # env stuff
 load_dotenv(dotenv_path='.env')
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 GEMINI_API = os.getenv('GOOGLE_API_KEY')
-client = genai.Client(api_key=GEMINI_API)
+# created on first use, see get_client()
+client = None
 guild_id =  int(os.getenv('GUILD_ID'))
 channel_id = int(os.getenv('CHANNEL_ID'))
 max_history = int(os.getenv('MAX_HISTORY', '10'))
 text_model = os.getenv("TEXT_MODEL", "gemini-2.0-flash")
 image_model = os.getenv('IMAGE_MODEL', "gemini-2.0-flash-preview-image-generation")
 MAX_MESSAGE_LENGTH = int(os.getenv('MAX_MESSAGE_LENGTH', '500'))
+USE_THREADS = os.getenv('USE_THREADS', 'true').lower() in ('1', 'true', 'yes', 'on')
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'false').lower() in ('1', 'true', 'yes', 'on')
+# discord allows roughly 5 edits per 5s per channel, stay under it
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.2'))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '1500'))
+SUMMARY_ENABLED = os.getenv('SUMMARY_ENABLED', 'false').lower() in ('1', 'true', 'yes', 'on')
+SUMMARY_EVERY = int(os.getenv('SUMMARY_EVERY', '20'))
+SUMMARY_TAIL = int(os.getenv('SUMMARY_TAIL', '6'))
+SUMMARY_MAX_WORDS = int(os.getenv('SUMMARY_MAX_WORDS', '250'))
+# comma separated subset of text,search,image
+RESPONSE_CACHE_FEATURES = {f.strip() for f in os.getenv('RESPONSE_CACHE_FEATURES', '').split(',') if f.strip()}
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '300'))
+RESPONSE_CACHE_ENTRIES = int(os.getenv('RESPONSE_CACHE_ENTRIES', '512'))
+PROMPT_CACHE_ENABLED = os.getenv('PROMPT_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes', 'on')
+PROMPT_CACHE_TTL = int(os.getenv('PROMPT_CACHE_TTL', '3600'))
+# Gemini only caches content above a minimum token count, shorter prompts are sent inline
+PROMPT_CACHE_MIN_CHARS = int(os.getenv('PROMPT_CACHE_MIN_CHARS', '8000'))
+MAX_INFLIGHT = int(os.getenv('MAX_INFLIGHT', '32'))
+MAX_QUEUE = int(os.getenv('MAX_QUEUE', '64'))
+MAX_QUEUE_WAIT = float(os.getenv('MAX_QUEUE_WAIT', '20'))
+# requests per minute and burst size per scope
+USER_RATE = (float(os.getenv('USER_RATE_PER_MIN', '6')), int(os.getenv('USER_BURST', '3')))
+CHANNEL_RATE = (float(os.getenv('CHANNEL_RATE_PER_MIN', '30')), int(os.getenv('CHANNEL_BURST', '10')))
+GUILD_RATE = (float(os.getenv('GUILD_RATE_PER_MIN', '120')), int(os.getenv('GUILD_BURST', '30')))
+BUSY_MESSAGE = os.getenv('BUSY_MESSAGE', "I'm a bit busy right now, try again in a moment.")
+NO_ANSWER_MESSAGE = os.getenv('NO_ANSWER_MESSAGE', "I couldn't come up with an answer to that.")
+# seconds to wait for follow-up messages in the dedicated channel before answering, 0 disables
+DEBOUNCE_SECONDS = float(os.getenv('DEBOUNCE_SECONDS', '0'))
+DEBOUNCE_MAX_MESSAGES = int(os.getenv('DEBOUNCE_MAX_MESSAGES', '8'))
+# local Prometheus endpoint at /metrics, 0 disables
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# log the running task and stack when the event loop is stuck this long, 0 disables
+WATCHDOG_THRESHOLD = float(os.getenv('WATCHDOG_THRESHOLD', '0.25'))
+WATCHDOG_INTERVAL = float(os.getenv('WATCHDOG_INTERVAL', '0.1'))
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', '0.005'))
+PROFILER_MAX_SECONDS = float(os.getenv('PROFILER_MAX_SECONDS', '300'))
+# "guild" syncs slash commands to GUILD_ID only (instant, for development), "global" everywhere
+COMMAND_SYNC_SCOPE = os.getenv('COMMAND_SYNC_SCOPE', 'global').lower()
+COMMAND_SYNC_STATE = os.getenv('COMMAND_SYNC_STATE', 'command_sync.json')
+FORCE_COMMAND_SYNC = os.getenv('FORCE_COMMAND_SYNC', 'false').lower() in ('1', 'true', 'yes', 'on')
+# unset: one plain connection, "auto": AutoShardedBot with Discord's recommended count, N: N shards
+SHARD_COUNT = os.getenv('SHARD_COUNT', '').lower()
+# this process's shards in cluster mode, e.g. "0-3" (set by cluster.py)
+SHARD_IDS = parse_shard_ids(os.getenv('SHARD_IDS', '')) or None
+CLUSTER_ID = int(os.getenv('CLUSTER_ID', '0'))
+# /image and /search run as background jobs, this many at a time, given up after the deadline (seconds)
+JOB_IMAGE_WORKERS = int(os.getenv('JOB_IMAGE_WORKERS', '2'))
+JOB_SEARCH_WORKERS = int(os.getenv('JOB_SEARCH_WORKERS', '2'))
+JOB_IMAGE_DEADLINE = int(os.getenv('JOB_IMAGE_DEADLINE', '300'))
+JOB_SEARCH_DEADLINE = int(os.getenv('JOB_SEARCH_DEADLINE', '1800'))
+# threads keep a multi-turn chat session instead of re-sending the flattened channel history every turn
+CHAT_SESSIONS = os.getenv('CHAT_SESSIONS', 'true').lower() in ('1', 'true', 'yes', 'on')
+CHAT_SESSION_TURNS = int(os.getenv('CHAT_SESSION_TURNS', '20'))
+CHAT_SESSION_TOKEN_BUDGET = int(os.getenv('CHAT_SESSION_TOKEN_BUDGET', '4000'))
+CHAT_SESSION_IDLE_SECONDS = int(os.getenv('CHAT_SESSION_IDLE_SECONDS', str(6 * 3600)))
+CHAT_SESSION_MAX = int(os.getenv('CHAT_SESSION_MAX', '1000'))
+# per-request model tiers (see model_router), guilds can override all of these with /config_edit
+MODEL_ROUTING = os.getenv('MODEL_ROUTING', 'false').lower() in ('1', 'true', 'yes', 'on')
+LITE_MODEL = os.getenv('LITE_MODEL', '')
+STRONG_MODEL = os.getenv('STRONG_MODEL', '')
+WORD_THRESHOLD = int(os.getenv('WORD_THRESHOLD', '500'))
+LITE_MAX_WORDS = int(os.getenv('LITE_MAX_WORDS', '40'))
+# retry an empty or blocked answer once on the next stronger tier
+ROUTING_ESCALATE = os.getenv('ROUTING_ESCALATE', 'true').lower() in ('1', 'true', 'yes', 'on')
+# calls waiting for a scheduler slot before requests drop one tier
+ROUTING_PRESSURE = int(os.getenv('ROUTING_PRESSURE', '8'))
+# seconds per Gemini operation, covering queueing, retries and hedges
+GEMINI_TEXT_DEADLINE = float(os.getenv('GEMINI_TEXT_DEADLINE', '60'))
+GEMINI_VISION_DEADLINE = float(os.getenv('GEMINI_VISION_DEADLINE', '90'))
+GEMINI_SEARCH_DEADLINE = float(os.getenv('GEMINI_SEARCH_DEADLINE', '120'))
+GEMINI_IMAGE_DEADLINE = float(os.getenv('GEMINI_IMAGE_DEADLINE', '180'))
+# longest gap between two chunks of a streamed reply
+GEMINI_STREAM_IDLE = float(os.getenv('GEMINI_STREAM_IDLE', '30'))
+GEMINI_RETRIES = int(os.getenv('GEMINI_RETRIES', '2'))
+GEMINI_RETRY_BASE = float(os.getenv('GEMINI_RETRY_BASE', '0.5'))
+GEMINI_RETRY_MAX = float(os.getenv('GEMINI_RETRY_MAX', '8'))
+# comma separated ops (text,chat,vision,search,summary,describe) that send a second request once the
+# first is slower than the recent HEDGE_QUANTILE latency, costs up to one extra call per slow request
+HEDGE_OPS = {op.strip() for op in os.getenv('HEDGE_OPS', '').split(',') if op.strip()}
+HEDGE_QUANTILE = float(os.getenv('HEDGE_QUANTILE', '0.95'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '50'))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+BREAKER_RESET_SECONDS = float(os.getenv('BREAKER_RESET_SECONDS', '30'))
+# model=fallback pairs, e.g. "gemini-2.5-flash=gemini-2.0-flash,gemini-2.0-flash=gemini-2.0-flash-lite"
+MODEL_FALLBACKS = dict(pair.split('=', 1) for pair in os.getenv('MODEL_FALLBACKS', '').replace(' ', '').split(',') if '=' in pair)
+TEXT_CONCURRENCY = int(os.getenv('TEXT_CONCURRENCY', '8'))
+IMAGE_CONCURRENCY = int(os.getenv('IMAGE_CONCURRENCY', '2'))
+SEARCH_CONCURRENCY = int(os.getenv('SEARCH_CONCURRENCY', '4'))
+HISTORY_CACHE_SIZE = max(max_history, int(os.getenv('HISTORY_CACHE_SIZE', '50')))
+HISTORY_CACHE_CHANNELS = int(os.getenv('HISTORY_CACHE_CHANNELS', '500'))
+HISTORY_IDLE_SECONDS = int(os.getenv('HISTORY_IDLE_SECONDS', '3600'))
+MAX_IMAGE_BYTES = int(os.getenv('MAX_IMAGE_BYTES', str(8 * 1024 * 1024)))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '32'))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', '8'))
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', '1024'))
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'JPEG')
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+IMAGE_USE_PROCESSES = os.getenv('IMAGE_USE_PROCESSES', 'false').lower() in ('1', 'true', 'yes', 'on')
+IMAGE_CACHE_ENTRIES = int(os.getenv('IMAGE_CACHE_ENTRIES', '256'))
+IMAGE_CACHE_BYTES = int(os.getenv('IMAGE_CACHE_BYTES', str(64 * 1024 * 1024)))
+IMAGE_CACHE_TTL = int(os.getenv('IMAGE_CACHE_TTL', str(6 * 3600)))
+# reuse a cached neutral description of the image instead of re-sending the image itself
+IMAGE_DESCRIPTION_CACHE = os.getenv('IMAGE_DESCRIPTION_CACHE', 'false').lower() in ('1', 'true', 'yes', 'on')
+
+# text: plain replies, image: vision replies and image generation, search: grounded search
+scheduler = GeminiScheduler({
+    "text": TEXT_CONCURRENCY,
+    "image": IMAGE_CONCURRENCY,
+    "search": SEARCH_CONCURRENCY,
+})
+
+# guilds without a stored config (or with unset values) fall back to these
+settings.set_defaults({
+    "max_history": max_history,
+    "text_model": text_model,
+    "image_model": image_model,
+    "set_channel": channel_id,
+    "threads": USE_THREADS,
+    "statistics": False,
+    "display_model": True,
+    "safety": False,
+    "routing": MODEL_ROUTING,
+    "escalate": ROUTING_ESCALATE,
+    "lite_model": LITE_MODEL,
+    "strong_model": STRONG_MODEL,
+    "word_threshold": WORD_THRESHOLD,
+    "lite_max_words": LITE_MAX_WORDS,
+})
+# history comes out of the per-channel ring buffers, which hold HISTORY_CACHE_SIZE messages at most
+settings.set_limits({"max_history": HISTORY_CACHE_SIZE})
+
+router = ModelRouter(lambda kind: scheduler.lanes[kind].waiting(), ROUTING_PRESSURE)
+
+# scheduler lane each Gemini op runs in
+OP_LANES = {"text": "text", "chat": "text", "summary": "text", "stream": "text",
+            "vision": "image", "describe": "image", "image": "image", "search": "search"}
+
+def hedge_delay(op):
+    if STAGE_SECONDS.count(stage="gemini", kind=op) < HEDGE_MIN_SAMPLES:
+        return None
+    return STAGE_SECONDS.percentile(HEDGE_QUANTILE, stage="gemini", kind=op)
+
+resilience = Resilience(
+    {"text": GEMINI_TEXT_DEADLINE, "chat": GEMINI_TEXT_DEADLINE, "summary": GEMINI_TEXT_DEADLINE, "stream": GEMINI_TEXT_DEADLINE,
+     "vision": GEMINI_VISION_DEADLINE, "describe": GEMINI_VISION_DEADLINE,
+     "search": GEMINI_SEARCH_DEADLINE, "image": GEMINI_IMAGE_DEADLINE},
+    GEMINI_RETRIES, GEMINI_RETRY_BASE, GEMINI_RETRY_MAX,
+    # a hedge only goes out when its lane has a free slot, never at the expense of queued requests
+    HEDGE_OPS, hedge_delay, lambda op: scheduler.has_capacity(OP_LANES.get(op, "text")),
+    BREAKER_FAILURES, BREAKER_RESET_SECONDS, MODEL_FALLBACKS,
+)
+history_cache = ChannelHistoryCache(HISTORY_CACHE_SIZE, HISTORY_CACHE_CHANNELS, HISTORY_IDLE_SECONDS)
+image_pipeline = ImagePipeline(IMAGE_MAX_EDGE, IMAGE_FORMAT, workers=IMAGE_WORKERS, use_processes=IMAGE_USE_PROCESSES)
+image_cache = ImageCache(IMAGE_CACHE_ENTRIES, IMAGE_CACHE_BYTES, IMAGE_CACHE_TTL)
+dispatcher = OutboundDispatcher()
+context_builder = ContextBuilder(CONTEXT_TOKEN_BUDGET)
+chat_sessions = ChatSessionStore(
+    context_builder.estimator.estimate, CHAT_SESSION_TURNS, CHAT_SESSION_TOKEN_BUDGET, CHAT_SESSION_IDLE_SECONDS,
+    CHAT_SESSION_MAX, get_store(),
+)
+# None unless SHARED_BACKEND is set, i.e. several processes serving one bot
+shared = get_shared_backend()
+response_cache = ResponseCache(
+    RESPONSE_CACHE_FEATURES, RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_TTL, shared,
+    encode=lambda response: response.model_dump_json(exclude_none=True),
+    decode=lambda raw: types.GenerateContentResponse.model_validate_json(raw),
+)
+admission = AdmissionController(
+    {"user": USER_RATE, "channel": CHANNEL_RATE, "guild": GUILD_RATE},
+    MAX_INFLIGHT, MAX_QUEUE, MAX_QUEUE_WAIT, shared,
+)
+debouncer = MessageDebouncer(DEBOUNCE_SECONDS, DEBOUNCE_MAX_MESSAGES)
+prompt_context_cache = (
+    PromptContextCache(GeminiCachedContentBackend(lambda: get_client()), PROMPT_CACHE_TTL, min_chars=PROMPT_CACHE_MIN_CHARS)
+    if PROMPT_CACHE_ENABLED else None
+)
+
+watchdog = LoopWatchdog(WATCHDOG_THRESHOLD, WATCHDOG_INTERVAL) if WATCHDOG_THRESHOLD > 0 else None
+profiler = SamplingProfiler(PROFILER_INTERVAL, PROFILER_MAX_SECONDS)
+
+registry.gauge("bot_component_stats", "Counters and sizes reported by the bot's caches and queues", lambda: flatten_stats({
+    "scheduler": scheduler.stats,
+    "router": router.stats,
+    "resilience": resilience.stats,
+    "history_cache": history_cache.stats,
+    "image_cache": image_cache.stats,
+    "response_cache": response_cache.stats,
+    "dispatcher": dispatcher.stats,
+    "admission": admission.stats,
+    "debouncer": debouncer.stats,
+    "jobs": lambda: job_queue.stats(),
+    "chat_sessions": chat_sessions.stats,
+}))
+registry.gauge("bot_queue_depth", "Messages waiting for an admission slot", lambda: admission.waiting)
 
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-SAFETY_SETTINGS = [
-    types.SafetySetting(
-        category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-        threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    ),
-    types.SafetySetting(
-        category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-        threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    ),
-    types.SafetySetting(
-        category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-        threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    ),
-    types.SafetySetting(
-        category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix='!', intents=intents,
+        shard_count=None if SHARD_COUNT == "auto" else int(SHARD_COUNT), shard_ids=SHARD_IDS,
+    )
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
+
+def get_client():
+    global client
+    if client is None:
+        client = genai.Client(api_key=GEMINI_API)
+    return client
+
+@lru_cache(maxsize=1)
+def safety_settings():
+    return [
+        types.SafetySetting(
+            category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+            threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        ),
+        types.SafetySetting(
+            category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+            threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        ),
+        types.SafetySetting(
+            category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+            threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        ),
+        types.SafetySetting(
+            category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+            threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
+        ),
+        types.SafetySetting(
+        category=types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
         threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    ),
-    types.SafetySetting(
-    category=types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
-    threshold=types.HarmBlockThreshold.BLOCK_ONLY_HIGH,
-    ),
+        ),
 ]
 
 class PromptManager:
-    def __init__(self, json_path="prompts.json"):
+    def __init__(self, json_path="prompts.json", store=None, shared=None):
         self.json_path = json_path
+        self.store = store
+        self.shared = shared
         self.prompts_data = self.load_prompts()
+        # called with a prompt name whose content stops being used (switched away from or deleted)
+        self.listeners = []
+        if shared:
+            shared.subscribe("prompts", self.reload)
+
+    def _notify(self, name):
+        for listener in self.listeners:
+            listener(name)
+
+    def _changed(self, *released):
+        """Local listeners hear about released prompts right away, other processes through the shared backend"""
+        for name in released:
+            self._notify(name)
+        if self.shared:
+            self.shared.publish_nowait("prompts", {"released": list(released)})
+
+    def reload(self, payload):
+        """Another process changed the prompts, re-read them"""
+        self.prompts_data = self.load_prompts()
+        for name in payload.get("released", []):
+            self._notify(name)
 
     def load_prompts(self):
+        if self.store:
+            data = self.store.load_prompts()
+            if "default" not in data["prompts"]:
+                data = self._default_data()
+                self.store.replace_prompts(data)
+            return data
+
         if not os.path.exists(self.json_path):
-            default_data = {
-                "active_prompt": "default",
-                "prompts": {
-                    "default": {
-                        "name": "default",
-                        "content": "",
-                        "created_by": "Master",
-                        "created_at": datetime.now().isoformat(),
-                        "usage_count": 0,
-                        "is_active": True
-                    }
-                },
-                "usage_history": []
-            }
+            default_data = self._default_data()
             self.save_prompts(default_data)
             return default_data
         
@@ -96,6 +346,22 @@ class PromptManager:
                 os.rename(self.json_path, f"{self.json_path}.backup")
             return self.load_prompts()
 
+    def _default_data(self):
+        return {
+            "active_prompt": "default",
+            "prompts": {
+                "default": {
+                    "name": "default",
+                    "content": "",
+                    "created_by": "Master",
+                    "created_at": datetime.now().isoformat(),
+                    "usage_count": 0,
+                    "is_active": True
+                }
+            },
+            "usage_history": []
+        }
+
     def save_prompts(self, data=None):
         if data is None:
             data = self.prompts_data
@@ -120,16 +386,20 @@ class PromptManager:
             "is_active": False
         }
 
-        self.save_prompts()
+        if self.store:
+            self.store.save_prompt(self.prompts_data["prompts"][name])
+        else:
+            self.save_prompts()
+        self._changed()
 
     def get_active_prompt(self):
-        active_name = self.prompts_data.get("active_prompt", "default")
-        active_prompt = self.prompts_data["prompts"].get(active_name)
-
-        if active_prompt:
-            return active_prompt["content"]
+        return self.prompts_data["prompts"][self.get_active_prompt_name()]["content"]
 
-        return self.prompts_data["prompts"]["default"]["content"]
+    def get_active_prompt_name(self):
+        active_name = self.prompts_data.get("active_prompt", "default")
+        if active_name in self.prompts_data["prompts"]:
+            return active_name
+        return "default"
 
     def set_active_prompt(self, name, user_id):
         if name not in self.prompts_data["prompts"]:
@@ -143,16 +413,23 @@ class PromptManager:
         self.prompts_data["prompts"][name]["is_active"] = True
         self.prompts_data["prompts"][name]["usage_count"] += 1
 
-        self.prompts_data["usage_history"].append({
+        usage = {
             "prompt_name": name,
             "used_by": user_id,
             "used_at": datetime.now().isoformat()
-        })
+        }
+        self.prompts_data["usage_history"].append(usage)
 
         if len(self.prompts_data["usage_history"]) > 100:
             self.prompts_data["usage_history"] = self.prompts_data["usage_history"][-100:]
         
-        self.save_prompts()
+        if self.store:
+            changed = [self.prompts_data["prompts"][n] for n in {old_active, name} if n in self.prompts_data["prompts"]]
+            self.store.record_activation(name, changed, usage)
+        else:
+            self.save_prompts()
+
+        self._changed(*([old_active] if old_active != name else []))
         return True
     
     def get_all_prompts(self):
@@ -175,7 +452,12 @@ class PromptManager:
             self.set_active_prompt("default", user_id)
 
         del self.prompts_data["prompts"][name]
-        self.save_prompts()
+        if self.store:
+            self.store.delete_prompt(name)
+        else:
+            self.save_prompts()
+
+        self._changed(name)
         return True
     
     def get_recent_prompts(self, limit: int = 5):
@@ -189,60 +471,267 @@ class PromptManager:
         return recent_names[:limit]
 
 class GeminiService():
+    http_session: Optional[aiohttp.ClientSession] = None
+
+    @staticmethod
+    async def prompt_config(model, system_prompt, **kwargs):
+        """GenerateContentConfig for the active system prompt, pointing at server-side cached content when available"""
+        if prompt_context_cache is not None:
+            cached = await prompt_context_cache.get(model, prompt_manager.get_active_prompt_name(), system_prompt)
+            if cached:
+                return types.GenerateContentConfig(cached_content=cached, **kwargs)
+        return types.GenerateContentConfig(system_instruction=system_prompt, **kwargs)
+
     @staticmethod
-    async def generate_text_response(prompt, message_history):
+    async def open_session():
+        if GeminiService.http_session is None or GeminiService.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_POOL_PER_HOST,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            GeminiService.http_session = aiohttp.ClientSession(connector=connector)
+        return GeminiService.http_session
+
+    @staticmethod
+    async def close_session():
+        if GeminiService.http_session is not None and not GeminiService.http_session.closed:
+            await GeminiService.http_session.close()
+        GeminiService.http_session = None
+
+    @staticmethod
+    async def generate_text_response(prompt, message_history, guild_id=None, summary=None):
         try: 
             system_prompt = prompt_manager.get_active_prompt()
-
-            response = client.models.generate_content(
-                model=text_model,
-                    config=types.GenerateContentConfig(
-                        system_instruction=system_prompt),
-                    contents = [f"The users prompt: {prompt} \n \n Heres the last {max_history} message(s) in the channel for context: {message_history} "]
+            cfg = settings.resolve(guild_id)
+            contents = context_builder.build(prompt, message_history, summary=summary)
+
+            async def attempt(model):
+                config = await GeminiService.prompt_config(model, system_prompt)
+                return await tracked("text", model, get_client().aio.models.generate_content(
+                    model=model,
+                    config=config,
+                    contents = contents
+                ))
+
+            async def call(model):
+                cache_key = make_key(
+                    "text", model, system_prompt, normalize_prompt(prompt), context_hash(message_history, prompt, bot.user.id), summary
+                )
+                return await response_cache.get_or_call(
+                    "text", cache_key, lambda: resilience.call("text", model, attempt, lambda: scheduler.slot("text", guild_id)),
+                    cacheable=lambda r: bool(getattr(r, "text", None)),
                 )
-            text = getattr(response, "text", None)
-            if not text:
-                return "Error occurred during response" + str(response._error)
 
-            return response.text
+            tier, model = router.route(cfg, prompt)
+            response = await call(model)
+            if router.unanswered(response):
+                stronger = router.escalate(cfg, tier, model)
+                if stronger:
+                    response = await call(stronger[1])
+            usage = getattr(response, "usage_metadata", None)
+            context_builder.estimator.observe(
+                len(system_prompt or "") + ContextBuilder.text_length(contents), usage and usage.prompt_token_count
+            )
+            return getattr(response, "text", None) or NO_ANSWER_MESSAGE
 
         except Exception as e: 
-            print(f"Exception: {e}")
-            return f"Exception: {e}"
+            print(f"Gemini text error: {e!r}")
+            return failure_message(e)
 
     @staticmethod
-    async def generate_text_response_using_image(pil_image, prompt, message_history):
-        try: 
+    async def stream_text_response(prompt, message_history, guild_id=None, summary=None, contents=None, on_complete=None):
+        """Same request as generate_text_response, yielding text as it arrives.
+        contents replaces the built context (chat sessions), on_complete gets the full text of a finished stream"""
+        produced = False
+        collected = []
+        try:
             system_prompt = prompt_manager.get_active_prompt()
-
-            response = client.models.generate_content(
-                model=text_model,
-                config=types.GenerateContentConfig(
-                        system_instruction=system_prompt),
-                contents=[pil_image, f"The users prompt: {prompt}\n \n Heres the last {max_history} message(s) in the channel for context: {message_history}" if prompt else f"What is in this image? Heres the last {max_history} message(s) in the channel for context: {message_history}"] 
+            cfg = settings.resolve(guild_id)
+            # no escalation here, part of the answer is already on screen by the time it could be judged
+            _, model = router.route(cfg, prompt)
+            contents = contents or context_builder.build(prompt, message_history, summary=summary)
+
+            async def open_stream(model):
+                config = await GeminiService.prompt_config(model, system_prompt)
+                return await get_client().aio.models.generate_content_stream(
+                    model=model,
+                    config=config,
+                    contents = contents
                 )
-            
-            if not response: 
-                return f"Error occurred during response {response}"
-            return response.text
+
+            async with scheduler.slot("text", guild_id):
+                # retries and fallbacks only until the stream is open, nothing has been shown yet
+                stream = aiter(await resilience.call("stream", model, open_stream))
+                last = None
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(anext(stream), GEMINI_STREAM_IDLE)
+                    except StopAsyncIteration:
+                        break
+                    last = chunk
+                    text = getattr(chunk, "text", None)
+                    if text:
+                        produced = True
+                        collected.append(text)
+                        yield text
+                # usage metadata arrives on the final chunk
+                record_usage("stream", model, last)
+            if on_complete is not None and produced:
+                on_complete("".join(collected))
+
+        except Exception as e:
+            print(f"Gemini stream error: {e!r}")
+            if not produced:
+                yield failure_message(e)
+
+    @staticmethod
+    async def generate_chat_response(prompt, contents, guild_id=None, kind="text"):
+        """One turn of a thread's chat session: contents are the stored turns plus the new user turn (prompt).
+        Not response-cached, a conversation never repeats. Returns (text, None), or (None, message for the user)"""
+        try:
+            system_prompt = prompt_manager.get_active_prompt()
+            cfg = settings.resolve(guild_id)
+
+            async def attempt(model):
+                config = await GeminiService.prompt_config(model, system_prompt)
+                return await tracked("chat", model, get_client().aio.models.generate_content(
+                    model=model,
+                    config=config,
+                    contents=contents
+                ))
+
+            def call(model):
+                return resilience.call("vision" if kind == "image" else "chat", model, attempt, lambda: scheduler.slot(kind, guild_id))
+
+            tier, model = router.route(cfg, prompt, attachment=kind == "image", kind=kind)
+            response = await call(model)
+            if router.unanswered(response):
+                stronger = router.escalate(cfg, tier, model)
+                if stronger:
+                    response = await call(stronger[1])
+            usage = getattr(response, "usage_metadata", None)
+            context_builder.estimator.observe(
+                len(system_prompt or "") + ContextBuilder.text_length(contents), usage and usage.prompt_token_count
+            )
+            text = getattr(response, "text", None)
+            return (text, None) if text else (None, NO_ANSWER_MESSAGE)
+
+        except Exception as e:
+            print(f"Gemini chat error: {e!r}")
+            return None, failure_message(e)
+
+    @staticmethod
+    async def generate_text_response_using_image(image_bytes, mime_type, prompt, message_history, guild_id=None, summary=None):
+        try: 
+            system_prompt = prompt_manager.get_active_prompt()
+            cfg = settings.resolve(guild_id)
+            _, model = router.route(cfg, prompt, attachment=True, kind="image")
+            contents = context_builder.build(prompt, message_history, types.Part.from_bytes(data=image_bytes, mime_type=mime_type), summary)
+
+            async def attempt(model):
+                config = await GeminiService.prompt_config(model, system_prompt)
+                return await tracked("vision", model, get_client().aio.models.generate_content(
+                    model=model,
+                    config=config,
+                    contents=contents
+                ))
+
+            response = await resilience.call("vision", model, attempt, lambda: scheduler.slot("image", guild_id))
+            return getattr(response, "text", None) or NO_ANSWER_MESSAGE
         
         except Exception as e:
-            print(f"Exception: {e}")
-            return f"Exception: {e}"
+            print(f"Gemini vision error: {e!r}")
+            return failure_message(e)
         
     @staticmethod
-    async def generate_image(prompt):
+    async def summarize_history(previous_summary, lines, guild_id=None):
+        try:
+            instructions = (
+                f"Update the running summary of a Discord channel conversation. Keep it under {SUMMARY_MAX_WORDS} words, "
+                "keep names, open questions and decisions, drop small talk. Reply with the summary only."
+            )
+            history = "\n".join(lines)
+            # background work, the lite tier is plenty when routing is on
+            cfg = settings.resolve(guild_id)
+            model = router.model(cfg, "lite") if cfg.get("routing") else cfg["text_model"]
+
+            async def attempt(model):
+                return await tracked("summary", model, get_client().aio.models.generate_content(
+                    model=model,
+                    config=types.GenerateContentConfig(system_instruction=instructions),
+                    contents=[f"Current summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{history}"]
+                ))
+
+            response = await resilience.call("summary", model, attempt, lambda: scheduler.slot("text", guild_id))
+            return getattr(response, "text", None)
+
+        except Exception as e:
+            print(f"Gemini summary error: {e!r}")
+            return None
+
+    @staticmethod
+    async def describe_image(image_bytes, mime_type, guild_id=None):
+        try:
+            # no system prompt, the description is shared across guilds and personas
+            model = settings.resolve(guild_id)["text_model"]
+
+            async def attempt(model):
+                return await tracked("describe", model, get_client().aio.models.generate_content(
+                    model=model,
+                    contents=[
+                        types.Part.from_bytes(data=image_bytes, mime_type=mime_type),
+                        "Describe this image objectively and in detail, including any visible text.",
+                    ]
+                ))
+
+            response = await resilience.call("describe", model, attempt, lambda: scheduler.slot("image", guild_id))
+            return getattr(response, "text", None)
+
+        except Exception as e:
+            print(f"Gemini describe error: {e!r}")
+            return None
+
+    @staticmethod
+    async def load_image(url):
+        """Returns a cached ImageEntry for url, downloading and preprocessing it on a miss"""
+        entry = image_cache.get_by_url(url)
+        if entry:
+            return entry
+
+        with span("download"):
+            image_data = await GeminiService.download_image(url)
+        if not image_data:
+            return None
+
+        with span("preprocess"):
+            image_bytes, mime_type, digest = await image_pipeline.process(image_data.getvalue())
+        return image_cache.put(url, digest, image_bytes, mime_type)
+
+    @staticmethod
+    async def generate_image(prompt, guild_id=None):
+        """(image, caption) on success, (None, message for the user) otherwise"""
         try: 
             image_data = None
             caption = None
+            model = settings.resolve(guild_id)["image_model"]
 
-            response = client.models.generate_content(
-                model=image_model,
-                contents=[prompt],
-                config=types.GenerateContentConfig(
-                response_modalities=['TEXT', 'IMAGE'],
-                safety_settings=SAFETY_SETTINGS
-                ),
+
+            async def attempt(model):
+                return await tracked("image", model, get_client().aio.models.generate_content(
+                    model=model,
+                    contents=[prompt],
+                    config=types.GenerateContentConfig(
+                    response_modalities=['TEXT', 'IMAGE'],
+                    safety_settings=safety_settings()
+                    ),
+                ))
+
+            response = await response_cache.get_or_call(
+                "image", make_key("image", model, normalize_prompt(prompt)),
+                lambda: resilience.call("image", model, attempt, lambda: scheduler.slot("image", guild_id)),
+                cacheable=lambda r: bool(r.candidates),
             )
             
             if response.candidates and response.candidates[0].content and response.candidates[0].content.parts:
@@ -254,31 +743,41 @@ class GeminiService():
                     elif part.text:
                         caption = part.text.strip()
 
-            if not image_data or not caption: 
-                return None, "Error occurred during response - missing image or caption"
+            if not image_data: 
+                return None, caption or "I couldn't generate an image for that prompt."
             
             return image_data, caption
         
         except Exception as e:
-            return f"Exception: {e}"
+            print(f"Gemini image error: {e!r}")
+            return None, failure_message(e)
 
     @staticmethod
-    async def generate_search(prompt):
-        google_search_tool = Tool(
-            google_search = GoogleSearch()
+    async def generate_search(prompt, guild_id=None):
+        google_search_tool = types.Tool(
+            google_search = types.GoogleSearch()
         )
 
         try: 
             system_prompt = prompt_manager.get_active_prompt()
+            _, model = router.route(settings.resolve(guild_id), prompt, search=True, kind="search")
+            cache_key = make_key("search", model, system_prompt, normalize_prompt(prompt))
 
-            response = client.models.generate_content(
-                model=text_model,
-                contents=[prompt],
-                config=GenerateContentConfig(
-                    tools=[google_search_tool],
-                    response_modalities=["TEXT"],
-                    system_instruction=system_prompt,
-                )
+
+            async def attempt(model):
+                return await tracked("search", model, get_client().aio.models.generate_content(
+                    model=model,
+                    contents=[prompt],
+                    config=types.GenerateContentConfig(
+                        tools=[google_search_tool],
+                        response_modalities=["TEXT"],
+                        system_instruction=system_prompt,
+                    )
+                ))
+
+            response = await response_cache.get_or_call(
+                "search", cache_key, lambda: resilience.call("search", model, attempt, lambda: scheduler.slot("search", guild_id)),
+                cacheable=lambda r: bool(r.candidates),
             )
 
             full_response_text = []
@@ -288,11 +787,12 @@ class GeminiService():
                         full_response_text.append(part.text)
 
             if not full_response_text: 
-                return f"Error occurred during response"
+                return NO_ANSWER_MESSAGE
             
             return full_response_text
         except Exception as e:
-            return f"Exception: {e}"
+            print(f"Gemini search error: {e!r}")
+            return failure_message(e)
 
     @staticmethod  
     async def check_for_attachment(message):
@@ -314,26 +814,36 @@ class GeminiService():
         return None
 
     @staticmethod  
-    async def download_image(url, timeout=10):
+    async def download_image(url, timeout=10, max_bytes=None):
+        max_bytes = max_bytes or MAX_IMAGE_BYTES
         try:
             timeout_config = aiohttp.ClientTimeout(total=timeout)
-
-            async with aiohttp.ClientSession(timeout=timeout_config) as session:
-                async with session.get(url) as resp:
-                    if resp.status != 200:
-                        print(f"Non-200 status code: {resp.status}")
+            session = await GeminiService.open_session()
+
+            async with session.get(url, timeout=timeout_config) as resp:
+                if resp.status != 200:
+                    print(f"Non-200 status code: {resp.status}")
+                    return None
+
+                content_type = resp.headers.get('content-type', '')
+                if not content_type.lower().startswith('image/'):
+                    print(f"Not an image: {content_type or 'no content-type'}")
+                    return None
+
+                content_length = resp.headers.get('content-length')
+                if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+                    print(f"Image too large: {content_length} bytes")
+                    return None
+
+                image_data = BytesIO()
+                async for chunk in resp.content.iter_chunked(64 * 1024):
+                    if image_data.tell() + len(chunk) > max_bytes:
+                        print(f"Image exceeded {max_bytes} bytes, aborting download")
                         return None
+                    image_data.write(chunk)
 
-                    content_length = resp.headers.get('content-length')
-                    if content_length:
-                        print(f"Content length: {content_length} bytes")
-
-                    image_bytes = await resp.read()
-
-                    image_data = BytesIO(image_bytes)
-                    image_data.seek(0)
-
-                    return image_data 
+                image_data.seek(0)
+                return image_data 
 
         except Exception as e:
             print(f"Download error: {e}")
@@ -342,10 +852,12 @@ class GeminiService():
 class DiscordService():
     @staticmethod
     async def send_response(message, response):
+        debouncer.sending()
         if len(response) <= MAX_MESSAGE_LENGTH:
             await message.channel.send(response)
         else:
-            if isinstance(message.channel, discord.Thread):
+            use_threads = settings.resolve(message.guild.id if message.guild else 0)["threads"]
+            if isinstance(message.channel, discord.Thread) or not use_threads or not message.guild:
                 await DiscordService.send_in_chunks(message.channel, response)
             else:
                 await message.channel.send(f"Response is too long ({len(response)} chars), creating thread...")
@@ -353,8 +865,58 @@ class DiscordService():
                     name=f"AI Response - {message.author.display_name}",
                     auto_archive_duration=60
                 )
+                DiscordService.seed_session(thread, message, response)
                 await DiscordService.send_in_chunks(thread, response)
 
+    @staticmethod
+    def seed_session(thread, message, response):
+        """Follow-ups in a thread the bot opened for an answer continue from that exchange"""
+        if CHAT_SESSIONS:
+            chat_sessions.start(thread.id, message.guild.id, [
+                ("user", f"{message.author.display_name}: {message.clean_content}"), ("model", response)
+            ], message.id)
+
+    @staticmethod
+    async def stream_response(message, chunks, limit=1900):
+        """Posts a placeholder and edits it as chunks arrive, rolling over into new messages (or a thread) past the limit"""
+        loop = asyncio.get_running_loop()
+        use_threads = message.guild and settings.resolve(message.guild.id)["threads"]
+        target = message.channel
+        debouncer.sending()
+        current = await target.send("…")
+        text, shown, last_edit = "", None, loop.time()
+        full = []
+
+        async for delta in chunks:
+            text += delta
+            full.append(delta)
+
+            while len(text) > limit:
+                cut = text.rfind("\n", 0, limit)
+                if cut <= 0:
+                    cut = text.rfind(" ", 0, limit)
+                if cut <= 0:
+                    cut = limit
+                await current.edit(content=text[:cut])
+
+                if use_threads and target is message.channel and not isinstance(target, discord.Thread):
+                    target = await current.create_thread(
+                        name=f"AI Response - {message.author.display_name}",
+                        auto_archive_duration=60
+                    )
+                text = text[cut:].lstrip()
+                current = await target.send(text[:limit] or "…")
+                shown, last_edit = text[:limit], loop.time()
+
+            if text != shown and loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+                await current.edit(content=text or "…")
+                shown, last_edit = text, loop.time()
+
+        if text != shown:
+            await current.edit(content=text or NO_ANSWER_MESSAGE)
+        if target is not message.channel:
+            DiscordService.seed_session(target, message, "".join(full))
+
     @staticmethod
     async def get_attr_dict(obj):
         attrs = {}
@@ -375,7 +937,8 @@ class DiscordService():
         if len(response) <= MAX_MESSAGE_LENGTH:
             await interaction.followup.send(response)
         else:
-            if isinstance(interaction.channel, discord.Thread):
+            use_threads = settings.resolve(interaction.guild_id)["threads"]
+            if isinstance(interaction.channel, discord.Thread) or not use_threads or not interaction.guild:
                 await DiscordService.send_in_chunks(interaction.channel, response)
             else:
                 response_message = await interaction.original_response()
@@ -386,61 +949,171 @@ class DiscordService():
                 await DiscordService.send_in_chunks(thread, response)
 
     @staticmethod
-    async def send_in_chunks(channel, text, chunk_size=1900):
-        for i in range(0, len(text), chunk_size):
-            chunk = text[i:i + chunk_size]
-            await channel.send(chunk)
-            await asyncio.sleep(0.3)
+    async def send_in_chunks(channel, text):
+        return await dispatcher.send(channel, text)
 
 
-@bot.event
-async def on_ready():
-    print(f'{bot.user} has connected to Discord!')
+class CancelJobButton(discord.ui.DynamicItem[discord.ui.Button], template=r"job-cancel:(?P<job_id>[0-9a-f]+)"):
+    """Cancel button on a job's status message. Dynamic, so it keeps working after a restart"""
+
+    def __init__(self, job_id: str):
+        super().__init__(discord.ui.Button(label="Cancel", style=discord.ButtonStyle.danger, custom_id=f"job-cancel:{job_id}"))
+        self.job_id = job_id
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(match["job_id"])
+
+    async def callback(self, interaction: discord.Interaction):
+        if await job_queue.cancel(self.job_id, interaction.user.id):
+            await interaction.response.send_message("✅ Cancelled", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ This job already finished or isn't yours", ephemeral=True)
+
+def job_view(job_id):
+    view = discord.ui.View(timeout=None)
+    view.add_item(CancelJobButton(job_id))
+    return view
+
+class JobService():
+    STATUS = {"running": "⏳ running", "done": "✅ done", "cancelled": "cancelled", "failed": "❌ failed", "expired": "⌛ timed out"}
+
+    @staticmethod
+    async def run_image(job):
+        with span("model", kind="image"):
+            image_data, caption = await GeminiService.generate_image(job.prompt, job.guild_id)
+        return {"image": image_data.getvalue() if image_data else None, "text": caption}
+
+    @staticmethod
+    async def run_search(job):
+        with span("model", kind="search"):
+            response = await GeminiService.generate_search(job.prompt, job.guild_id)
+        return {"text": "\n".join(response) if isinstance(response, list) else response}
+
+    @staticmethod
+    async def get_channel(job):
+        """The job's channel, or a DM with the user when the channel is gone or closed to the bot"""
+        channel = bot.get_channel(job.channel_id)
+        if channel is not None:
+            return channel
+        try:
+            return await bot.fetch_channel(job.channel_id)
+        except discord.HTTPException:
+            user = await bot.fetch_user(job.user_id)
+            return await user.create_dm()
+
+    @staticmethod
+    async def deliver(job, result):
+        """Posts with channel.send rather than the interaction followup, whose token expires after 15 minutes"""
+        channel = await JobService.get_channel(job)
+        if job.message_id:
+            try:
+                # a running job can still be cancelled, keep its button
+                await channel.get_partial_message(job.message_id).edit(
+                    content=f"<@{job.user_id}> {job.kind}: {JobService.STATUS[job.status]}",
+                    view=job_view(job.id) if job.status == "running" else None
+                )
+            except discord.HTTPException:
+                pass
+
+        if job.status in ("failed", "expired"):
+            # job.error keeps the exception text for the logs, it isn't meant for the channel
+            print(f"Job {job.id} {job.status}: {job.error}")
+            reason = "it took too long" if job.status == "expired" else "something went wrong"
+            await channel.send(f"<@{job.user_id}> couldn't finish that {job.kind} request, {reason}.")
+        if job.status != "done":
+            return
+
+        with span("send"):
+            text = result.get("text") or ""
+            if job.kind == "image":
+                if not result.get("image"):
+                    # generate_image puts the reason in the text
+                    await channel.send(f"<@{job.user_id}> {text or NO_ANSWER_MESSAGE}")
+                    return
+                discord_file = discord.File(fp=BytesIO(result["image"]), filename="gemini_image.png")
+                if len(text) <= MAX_MESSAGE_LENGTH:
+                    await channel.send(content=f"<@{job.user_id}> {text}", file=discord_file)
+                    return
+                await channel.send(content=f"<@{job.user_id}>", file=discord_file)
+            await JobService.deliver_text(job, channel, f"<@{job.user_id}> {text}" if job.kind == "search" else text)
+
+    @staticmethod
+    async def deliver_text(job, channel, text):
+        target = channel
+        use_threads = settings.resolve(job.guild_id)["threads"]
+        if len(text) > MAX_MESSAGE_LENGTH and use_threads and job.guild_id and job.message_id and not isinstance(channel, discord.Thread):
+            target = await channel.get_partial_message(job.message_id).create_thread(
+                name=f"AI Response - {job.kind}", auto_archive_duration=60
+            )
+        await DiscordService.send_in_chunks(target, text)
+
+    @staticmethod
+    def owns(job):
+        """In cluster mode every process resumes only the jobs of guilds on its own shards"""
+        if SHARD_IDS is None or SHARD_COUNT in ("", "auto"):
+            return True
+        return (job.guild_id >> 22) % int(SHARD_COUNT) in SHARD_IDS
+
+
+job_queue = JobQueue(
+    JobStore(get_store()),
+    {"image": JobService.run_image, "search": JobService.run_search},
+    JobService.deliver,
+    {"image": JOB_IMAGE_WORKERS, "search": JOB_SEARCH_WORKERS},
+    {"image": JOB_IMAGE_DEADLINE, "search": JOB_SEARCH_DEADLINE},
+)
+
+summarizer = ChannelSummarizer(
+    GeminiService.summarize_history, lambda: settings.db_manager, history_cache, SUMMARY_EVERY, SUMMARY_TAIL
+)
+
+async def setup_hook():
+    """Runs once per process before connecting, unlike on_ready which fires again on every reconnect"""
+    bot.add_dynamic_items(CancelJobButton)
+    await job_queue.start(JobService.owns)
+    if CHAT_SESSIONS:
+        await chat_sessions.load()
+
+    if CLUSTER_ID != 0:
+        # the command tree is global, one process syncing it is enough
+        return
+    guild = discord.Object(guild_id) if COMMAND_SYNC_SCOPE == "guild" else None
+    if guild is not None:
+        bot.tree.copy_global_to(guild=guild)
     try:
-        synced = await bot.tree.sync()
-        print(f"Synced {len(synced)} command(s)")
+        synced = await sync_commands(bot.tree, bot.application_id, CommandSyncState(COMMAND_SYNC_STATE), guild, FORCE_COMMAND_SYNC)
+        if synced is None:
+            print("Command tree unchanged, skipping sync")
+        else:
+            print(f"Synced {len(synced)} command(s) {'to guild ' + str(guild_id) if guild else 'globally'}")
     except Exception as e:
         print(f"Failed to sync commands: {e}")
 
-@bot.tree.command(name="image", description="Generate an image")
-@app_commands.describe(prompt="Describe the image")
-async def generate_image_slash(interaction: discord.Interaction, prompt: str):
-    await interaction.response.send_message(f"{interaction.user.mention} Generating image...")
-    try: 
-        image_data, caption = await GeminiService.generate_image(prompt)
+bot.setup_hook = setup_hook
 
-        if image_data:
-            discord_file = discord.File(fp=image_data, filename="gemini_image.png")
+@bot.event
+async def on_ready():
+    print(f'{bot.user} has connected to Discord!')
 
-            if len(caption) <= MAX_MESSAGE_LENGTH:
-                await interaction.followup.send(content=caption, file=discord_file)
-            else:
-                await interaction.followup.send(file=discord_file)
-                await DiscordService.send_interaction_response(interaction, caption)
-        else:
-            await interaction.followup.send("couldn't generate an image for that prompt.")
+async def submit_job(interaction: discord.Interaction, kind: str, prompt: str, label: str):
+    """Queues the work and answers the interaction right away, the result is posted to the channel later"""
+    job = job_queue.new_job(kind, prompt, interaction.guild_id or 0, interaction.channel_id, interaction.user.id)
+    ahead = job_queue.pending(kind)
+    queued = f" ({ahead} ahead of you)" if ahead else ""
+    await interaction.response.send_message(f"{interaction.user.mention} {label}{queued}", view=job_view(job.id))
+    job.message_id = (await interaction.original_response()).id
+    await job_queue.submit(job)
 
-    except Exception as e:
-        await interaction.followup.send(f"An error occurred: {e}")
+@bot.tree.command(name="image", description="Generate an image")
+@app_commands.describe(prompt="Describe the image")
+async def generate_image_slash(interaction: discord.Interaction, prompt: str):
+    await submit_job(interaction, "image", prompt, "Generating image...")
 
 @bot.tree.command(name="search", description="Use google search on gemini")
 @app_commands.describe(prompt="Prompt for google search")
 async def slash_search(interaction: discord.Interaction, prompt: str):
-    # await interaction.response.defer(thinking=True)
-    await interaction.response.send_message(f"{interaction.user.mention} Searching... (this can take from 5s-30m)")
-
-    async with interaction.channel.typing():
-        try:
-            response = await GeminiService.generate_search(prompt)
-            
-            if isinstance(response, list):
-                await DiscordService.send_interaction_response(interaction, "\n".join(response))
-            else:
-                await interaction.followup.send(response)
-
-        except Exception as e:
-            print(f"error: {e}")
-            await interaction.followup.send(f"error: {e}")
+    await submit_job(interaction, "search", prompt, "Searching... (this can take from 5s-30m)")
 
 async def prompt_name_autocomplete(
     interaction: discord.Interaction,
@@ -556,6 +1229,104 @@ async def delete_prompt(interaction: discord.Interaction, name: str):
     except Exception as e:
         await interaction.followup.send(f"❌ Error: {e}")
 
+def field_lines(lines, noun, limit=1024):
+    """As many whole lines as fit in an embed field value, with a note on how many were left out"""
+    shown, size = [], 0
+    for n, line in enumerate(lines):
+        more = f"…and {len(lines) - n} more {noun}"
+        # keep room for the note in case a later line doesn't fit
+        reserve = len(more) + 1 if n < len(lines) - 1 else 0
+        if size + len(line) + 1 + reserve > limit:
+            shown.append(more)
+            break
+        shown.append(line)
+        size += len(line) + 1
+    return "\n".join(shown)
+
+@bot.tree.command(name="stats", description="Show latency, token and cache statistics")
+async def show_stats(interaction: discord.Interaction):
+    if not settings.resolve(interaction.guild_id)["statistics"]:
+        await interaction.response.send_message("❌ Statistics are disabled for this server (`/config_edit statistics true`)", ephemeral=True)
+        return
+
+    embed = discord.Embed(title="Bot statistics", color=0x0099ff)
+
+    lines = []
+    for labels, count, p50, p99 in sorted(STAGE_SECONDS.summaries(), key=lambda s: sorted(s[0].items())):
+        name = " ".join([labels.pop("stage", "")] + list(labels.values()))
+        lines.append(f"`{name}` n={count} p50={p50 * 1000:.0f}ms p99={p99 * 1000:.0f}ms")
+    embed.add_field(name="Latency", value=field_lines(lines, "series") or "No samples yet", inline=False)
+
+    tokens = {}
+    for key, value in TOKENS.values.items():
+        direction = dict(key)["direction"]
+        tokens[direction] = tokens.get(direction, 0) + value
+    embed.add_field(name="Tokens", value="\n".join(f"{d}: {int(v)}" for d, v in tokens.items()) or "None", inline=True)
+
+    rc, ic = response_cache.stats(), image_cache.stats()
+    embed.add_field(
+        name="Caches",
+        value=f"Responses: {rc['hits']} hits / {rc['misses']} misses / {rc['coalesced']} coalesced\n"
+              f"Images: {ic['hits']} hits / {ic['misses']} misses",
+        inline=True
+    )
+
+    adm = admission.stats()
+    lanes = ", ".join(f"{kind} {lane['active']}/{lane['limit']} (+{lane['waiting']})" for kind, lane in scheduler.stats().items())
+    embed.add_field(
+        name="Load",
+        value=f"In flight: {adm['inflight']}, queued: {adm['queue_depth']}\n"
+              f"Rejected: {', '.join(f'{r} {n}' for r, n in adm['rejected'].items())}\n"
+              f"Gemini lanes: {lanes}",
+        inline=False
+    )
+    embed.add_field(name="Errors", value=str(int(sum(ERRORS.values.values()))), inline=True)
+    if watchdog is not None:
+        lag = LOOP_LAG.percentile(0.99)
+        embed.add_field(
+            name="Event loop",
+            value=f"p99 lag: {lag * 1000:.0f}ms\nStalls: {int(STALLS.get())}" if lag is not None else "No samples yet",
+            inline=True
+        )
+
+    await interaction.response.send_message(embed=embed)
+
+@bot.tree.command(name="profile", description="Start or stop the sampling profiler")
+@app_commands.describe(action="start, stop (uploads collapsed stacks) or status")
+@app_commands.choices(action=[
+    app_commands.Choice(name="start", value="start"),
+    app_commands.Choice(name="stop", value="stop"),
+    app_commands.Choice(name="status", value="status"),
+])
+@app_commands.default_permissions(administrator=True)
+async def profile(interaction: discord.Interaction, action: str):
+    if action == "start":
+        if profiler.start():
+            await interaction.response.send_message(f"✅ Profiler started, stops by itself after {PROFILER_MAX_SECONDS:.0f}s", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ Profiler is already running", ephemeral=True)
+
+    elif action == "stop":
+        await interaction.response.defer(ephemeral=True)
+        # joining the sampler thread takes up to one interval, keep it off the loop
+        collapsed = await asyncio.to_thread(profiler.stop)
+        if not collapsed:
+            await interaction.followup.send("❌ No samples, start the profiler first", ephemeral=True)
+            return
+        file = discord.File(BytesIO(collapsed.encode()), filename="profile.collapsed.txt")
+        await interaction.followup.send(
+            f"✅ {sum(profiler.samples.values())} samples, load into speedscope or flamegraph.pl", file=file, ephemeral=True
+        )
+
+    else:
+        state = "running" if profiler.running else "stopped"
+        stalls = watchdog.stalls if watchdog else "watchdog disabled"
+        await interaction.response.send_message(f"Profiler {state}, loop stalls so far: {stalls}", ephemeral=True)
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    COMMANDS.inc(command=command.qualified_name)
+
 @bot.command()
 async def dox(ctx, member: discord.Member = None):
     if member is None:
@@ -586,60 +1357,247 @@ async def dox(ctx, member: discord.Member = None):
         await ctx.send(f"```{chunk}```")
 
 @bot.event
-async def on_message(message):
-    if message.author.bot:
-        return
-    
-    message_history = []
+async def on_raw_message_edit(payload):
+    if "content" in payload.data:
+        history_cache.edit(payload.channel_id, payload.message_id, payload.data["content"])
 
-    if message.channel.id == channel_id or bot.user.mentioned_in(message) or (message.reference and message.reference.resolved and message.reference.resolved.author == bot.user):
-        async with message.channel.typing():
-            async for msg_in_history in message.channel.history(limit=max_history):
-                if msg_in_history.id == message.id:
-                    continue
-                message_history.append(f'{msg_in_history.author.display_name}:  {msg_in_history.content}')
+@bot.event
+async def on_raw_message_delete(payload):
+    history_cache.delete(payload.channel_id, payload.message_id)
 
-            message_history.reverse()  
-            mention_pattern = rf'<@!?\s*{bot.user.id}>'
-            prompt = re.sub(mention_pattern, '', message.content).strip()
-            
-            attachment_url = await GeminiService.check_for_attachment(message)
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    for message_id in payload.message_ids:
+        history_cache.delete(payload.channel_id, message_id)
+
+async def respond(messages, cfg):
+    """Answers a batch of messages from one author (usually just one) as a single prompt, anchored on the last"""
+    message = messages[-1]
+    batch_ids = {m.id for m in messages}
+    message_history = []
+    guild_id = message.guild.id if message.guild else 0
+
+    mention_pattern = rf'<@!?\s*{bot.user.id}>'
+    prompt = "\n".join(
+        text for text in (re.sub(mention_pattern, '', m.content).strip() for m in messages) if text
+    )
+
+    async with message.channel.typing():
+        if CHAT_SESSIONS and isinstance(message.channel, discord.Thread):
+            await respond_in_session(messages, prompt, cfg)
+            return
+
+        with span("history"):
+            recent = await history_cache.recent(message.channel, cfg["max_history"] + len(messages) - 1)
+        for msg_in_history in recent:
+            if msg_in_history["id"] in batch_ids:
+                continue
+            message_history.append(msg_in_history)
 
-            if attachment_url:
-                image_data = await GeminiService.download_image(attachment_url)
+        summary = None
+        if SUMMARY_ENABLED:
+            summarizer.activate(message.channel.id)
+            summary, message_history = summarizer.context(message.channel.id, message_history)
+
+        try:
+            attachment_url, image = await attached_image(messages, guild_id)
+        except Exception as e:
+            await image_failed(message, e)
+            return
 
-                if not image_data:
+        if attachment_url:
+            try:
+                if not image:
                     await message.channel.send('Unable to download the image.')
                     return
 
-                try:
-                    image_data.seek(0)
-                    pil_image = Image.open(image_data)
-
-                    if pil_image.mode in ('P', 'RGBA', 'LA', 'I'):
-                        pil_image = pil_image.convert('RGB')
-                    
-                    response = await GeminiService.generate_text_response_using_image(pil_image, prompt, message_history)
+                with span("model", kind="vision"):
+                    if IMAGE_DESCRIPTION_CACHE and image.description:
+                        response = await GeminiService.generate_text_response(
+                            f"{prompt or 'What is in this image?'}\n[Attached image: {image.description}]", message_history, guild_id, summary
+                        )
+                    else:
+                        response = await GeminiService.generate_text_response_using_image(image.image_bytes, image.mime_type, prompt, message_history, guild_id, summary)
+                with span("send"):
                     await DiscordService.send_response(message, response)
 
-                except Exception as e:
-                    print(f"error processing image: {e}")
-                    await message.channel.send("error processing the image.")
-                return
+            except Exception as e:
+                await image_failed(message, e)
+            return
 
-            else:
-                response = await GeminiService.generate_text_response(prompt, message_history)
+        elif STREAM_RESPONSES:
+            # model and send overlap when streaming, time them together
+            with span("stream"):
+                await DiscordService.stream_response(message, GeminiService.stream_text_response(prompt, message_history, guild_id, summary))
 
+        else:
+            with span("model", kind="text"):
+                response = await GeminiService.generate_text_response(prompt, message_history, guild_id, summary)
+
+            with span("send"):
                 await DiscordService.send_response(message, response)
 
+async def attached_image(messages, guild_id):
+    """The batch's newest image as (url, ImageEntry), described when IMAGE_DESCRIPTION_CACHE is on.
+    url is None without an attachment, the entry is None when the image couldn't be downloaded"""
+    with span("attachment"):
+        attachment_url = None
+        for m in reversed(messages):
+            attachment_url = await GeminiService.check_for_attachment(m)
+            if attachment_url:
+                break
+    if not attachment_url:
+        return None, None
+
+    image = await GeminiService.load_image(attachment_url)
+    if image and IMAGE_DESCRIPTION_CACHE and image.description is None:
+        with span("model", kind="describe"):
+            image.description = await GeminiService.describe_image(image.image_bytes, image.mime_type, guild_id)
+    return attachment_url, image
+
+async def image_failed(message, e):
+    ERRORS.inc(stage="respond", error=type(e).__name__)
+    print(f"error processing image: {e}")
+    await message.channel.send("error processing the image.")
+
+def session_turn(entry):
+    """A history cache entry as a (role, text) chat turn"""
+    if entry["author_id"] == bot.user.id:
+        return "model", entry["content"]
+    return "user", f"{entry['author']}: {entry['content']}" if entry["content"] else ""
+
+async def respond_in_session(messages, prompt, cfg):
+    """Thread replies: the thread's chat session plus only what was said since its last turn"""
+    message = messages[-1]
+    thread = message.channel
+    batch_ids = {m.id for m in messages}
+    guild_id = message.guild.id if message.guild else 0
+
+    with span("history"):
+        session = chat_sessions.get(thread.id)
+        recent = await history_cache.recent(thread, cfg["max_history"] + len(messages) - 1)
+        if session is None:
+            # new or expired: seeded once from the thread's recent messages, later turns only append
+            session = chat_sessions.start(
+                thread.id, guild_id, [session_turn(entry) for entry in recent if entry["id"] not in batch_ids], message.id
+            )
+            missed = []
+        else:
+            # messages since the last turn that the bot didn't answer (rate limited, sent while it was busy)
+            missed = [
+                f"{entry['author']}: {entry['content']}" for entry in recent
+                if entry["id"] > session.last_message_id and entry["id"] not in batch_ids
+                and entry["author_id"] != bot.user.id and entry["content"]
+            ]
+
+    user_text = "\n".join(missed + [f"{message.author.display_name}: {prompt or '(you were mentioned without a message)'}"])
+    image_part = None
+    stored_text = user_text
+
+    try:
+        attachment_url, image = await attached_image(messages, guild_id)
+    except Exception as e:
+        await image_failed(message, e)
+        return
+
+    if attachment_url and not image:
+        await message.channel.send('Unable to download the image.')
+        return
+    if image and IMAGE_DESCRIPTION_CACHE and image.description:
+        user_text += f"\n[Attached image: {image.description}]"
+        stored_text = user_text
+    elif image:
+        image_part = types.Part.from_bytes(data=image.image_bytes, mime_type=image.mime_type)
+        # sessions keep text only, later turns just know there was an image
+        stored_text = user_text + "\n[Attached image]"
+
+    contents = session.contents(user_text, image_part)
+    remember = lambda reply: chat_sessions.record(session, stored_text, reply, message.id)
+
+    if STREAM_RESPONSES:
+        with span("stream"):
+            await DiscordService.stream_response(message, GeminiService.stream_text_response(
+                prompt, [], guild_id, contents=contents, on_complete=remember
+            ))
+        return
+
+    with span("model", kind="chat"):
+        response, failure = await GeminiService.generate_chat_response(prompt, contents, guild_id, "image" if image_part else "text")
+    if response:
+        remember(response)
+
+    with span("send"):
+        await DiscordService.send_response(message, response or failure)
+
+@bot.event
+async def on_message(message):
+    history_cache.add(message)
+    if SUMMARY_ENABLED:
+        summarizer.note(message)
+
+    if message.author.bot:
+        return
+    
+    guild_id = message.guild.id if message.guild else 0
+    cfg = settings.resolve(guild_id)
+
+    if message.channel.id == cfg["set_channel"] and DEBOUNCE_SECONDS > 0:
+        debouncer.submit(message, lambda batch: handle_messages(batch, cfg))
+
+    elif (
+        message.channel.id == cfg["set_channel"] or bot.user.mentioned_in(message)
+        or (message.reference and message.reference.resolved and message.reference.resolved.author == bot.user)
+        # a thread the bot opened for its own answer is a conversation with it, no mention needed there
+        or (CHAT_SESSIONS and isinstance(message.channel, discord.Thread) and message.channel.owner_id == bot.user.id
+            and chat_sessions.active(message.channel.id))
+    ):
+        await handle_messages([message], cfg)
+
     await bot.process_commands(message)
 
+async def handle_messages(messages, cfg):
+    message = messages[-1]
+    guild_id = message.guild.id if message.guild else 0
+    try:
+        async with admission.admit(message.author.id, message.channel.id, guild_id):
+            with span("message"):
+                await respond(messages, cfg)
+    except Rejected as e:
+        # rate limited users are dropped silently, replying would only double the spam
+        if e.reason != "rate_limited":
+            await message.channel.send(BUSY_MESSAGE)
+
 if __name__ == "__main__":
-    prompt_manager = PromptManager("prompts.json")
+    prompt_manager = PromptManager("prompts.json", get_store(), shared)
+    if prompt_context_cache is not None:
+        prompt_manager.listeners.append(prompt_context_cache.invalidate)
 
     async def main():
         async with bot:
-            await bot.load_extension("config_manager")
-            await bot.start(DISCORD_TOKEN)
+            await GeminiService.open_session()
+            if prompt_context_cache is not None:
+                prompt_context_cache.start()
+            if shared is not None:
+                shared.start()
+            # one port per cluster process
+            metrics_runner = await start_http_server(METRICS_PORT + CLUSTER_ID, METRICS_HOST) if METRICS_PORT else None
+            if watchdog is not None:
+                watchdog.start()
+            try:
+                await bot.load_extension("config_manager")
+                await bot.start(DISCORD_TOKEN)
+            finally:
+                await GeminiService.close_session()
+                image_pipeline.shutdown()
+                if prompt_context_cache is not None:
+                    await prompt_context_cache.close()
+                if metrics_runner is not None:
+                    await metrics_runner.cleanup()
+                if watchdog is not None:
+                    await watchdog.stop()
+                await job_queue.close()
+                await chat_sessions.close()
+                if shared is not None:
+                    await shared.close()
 
     asyncio.run(main())
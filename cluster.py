@@ -0,0 +1,106 @@
+"""Runs the bot as several processes, each owning a contiguous range of shards.
+
+    python cluster.py --shards 8 --clusters 2
+
+Every process gets SHARD_COUNT, SHARD_IDS and CLUSTER_ID in its environment and is restarted with
+backoff when it exits. State that must agree across processes (guild config, prompts, rate limits,
+the response cache) needs STORAGE_BACKEND=sqlite and SHARED_BACKEND=sqlite or redis, which this
+launcher defaults to when they're unset.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sys
+import time
+
+from dotenv import load_dotenv
+
+
+def parse_shard_ids(spec: str):
+    """"0-3,6" -> [0, 1, 2, 3, 6]"""
+    ids = []
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            ids.extend(range(int(start), int(end) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+
+def shard_ranges(shard_count: int, clusters: int):
+    """Splits shard ids into `clusters` contiguous, nearly equal ranges"""
+    base, extra = divmod(shard_count, clusters)
+    ranges, start = [], 0
+    for cluster in range(clusters):
+        size = base + (1 if cluster < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return [r for r in ranges if r]
+
+
+async def supervise(cluster_id: int, shard_ids, shard_count: int, args, stopping: asyncio.Event):
+    env = {
+        **os.environ,
+        "SHARD_COUNT": str(shard_count),
+        "SHARD_IDS": f"{shard_ids[0]}-{shard_ids[-1]}",
+        "CLUSTER_ID": str(cluster_id),
+    }
+    backoff = 1.0
+    while not stopping.is_set():
+        started = time.monotonic()
+        print(f"[cluster {cluster_id}] starting shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}")
+        proc = await asyncio.create_subprocess_exec(sys.executable, args.script, env=env)
+
+        stop_wait = asyncio.create_task(stopping.wait())
+        exit_wait = asyncio.create_task(proc.wait())
+        await asyncio.wait({stop_wait, exit_wait}, return_when=asyncio.FIRST_COMPLETED)
+        stop_wait.cancel()
+
+        if stopping.is_set():
+            if proc.returncode is None:
+                proc.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(proc.wait(), 30)
+                except asyncio.TimeoutError:
+                    proc.kill()
+            return
+
+        print(f"[cluster {cluster_id}] exited with {proc.returncode}")
+        # a process that ran for a while gets a fresh backoff, a crash loop backs off up to a minute
+        backoff = 1.0 if time.monotonic() - started > 60 else min(backoff * 2, 60)
+        try:
+            await asyncio.wait_for(stopping.wait(), backoff)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def main(args):
+    # read .env first, the defaults below would otherwise shadow its values in the children,
+    # whose load_dotenv leaves variables that are already set alone
+    load_dotenv(dotenv_path='.env')
+    os.environ.setdefault("STORAGE_BACKEND", "sqlite")
+    os.environ.setdefault("SHARED_BACKEND", "sqlite")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    ranges = shard_ranges(args.shards, args.clusters)
+    await asyncio.gather(*(
+        supervise(cluster_id, shard_ids, args.shards, args, stopping)
+        for cluster_id, shard_ids in enumerate(ranges)
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the bot as multiple shard processes")
+    parser.add_argument("--shards", type=int, required=True, help="total shard count")
+    parser.add_argument("--clusters", type=int, default=os.cpu_count() or 1, help="number of processes")
+    parser.add_argument("--script", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "chatbot.py"))
+    asyncio.run(main(parser.parse_args()))
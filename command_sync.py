@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+import tempfile
+
+
+def tree_digest(tree, guild=None) -> str:
+    """Digest of the command payloads Discord would receive from tree.sync(guild=guild)"""
+    payload = sorted(
+        (command.to_dict(tree) for command in tree.get_commands(guild=guild)),
+        key=lambda command: (command.get("type", 1), command["name"]),
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class CommandSyncState:
+    """Last synced digest per application and scope, kept in a small JSON file next to the bot"""
+
+    def __init__(self, path: str = "command_sync.json"):
+        self.path = path
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def get(self, key: str):
+        return self._read().get(key)
+
+    def set(self, key: str, digest: str):
+        data = self._read()
+        data[key] = digest
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp, self.path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+
+async def sync_commands(tree, application_id, state: CommandSyncState, guild=None, force: bool = False):
+    """Syncs the tree (globally, or to one guild) only when its digest changed since the last sync.
+    Returns the synced commands, or None when the sync was skipped"""
+    key = f"{application_id}:{guild.id if guild else 'global'}"
+    digest = tree_digest(tree, guild)
+    if not force and state.get(key) == digest:
+        return None
+
+    synced = await tree.sync(guild=guild)
+    state.set(key, digest)
+    return synced
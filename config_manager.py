@@ -1,17 +1,23 @@
 import discord
+import asyncio
 import json
 import os
 import io 
+import tempfile
 from jsonschema import validate, ValidationError
 from discord import app_commands
 from discord.ext import commands
 
+import storage
+import shared_state
+from guild_settings import settings
+
 config_path = "config.json"
 
 SETTINGS = {
-    "INT": {"max_history", "word_threshold", "set_channel"},
-    "BOOL": {"threads", "statistics", "display_model", "safety"},
-    "STR": {"image_model", "text_model"},
+    "INT": {"max_history", "word_threshold", "set_channel", "lite_max_words"},
+    "BOOL": {"threads", "statistics", "display_model", "safety", "routing", "escalate"},
+    "STR": {"image_model", "text_model", "lite_model", "strong_model"},
 }
 
 config_schema = {
@@ -25,7 +31,13 @@ config_schema = {
     "display_model": {"type": "boolean"},
     "safety": {"type": "boolean"},
     "image_model": {"type": "string"},
-    "text_model": {"type": "string"}
+    "text_model": {"type": "string"},
+    # model routing, optional so configs exported before it existed still import
+    "routing": {"type": "boolean"},
+    "escalate": {"type": "boolean"},
+    "lite_model": {"type": "string"},
+    "strong_model": {"type": "string"},
+    "lite_max_words": {"type": "integer"}
     },
     "required": ["max_history", "word_threshold", "set_channel", "threads", "statistics", "display_model", "safety", "image_model", "text_model"]
 }
@@ -33,15 +45,42 @@ config_schema = {
 ALL_OPTIONS = sorted(list(SETTINGS["INT"] | SETTINGS["BOOL"] | SETTINGS["STR"]))
 
 class DB_Manager:
-    def __init__(self, path: str = config_path):
+    """Authoritative in-memory copy of the guild config. Mutations go through the lock and are flushed debounced,
+    either as a whole config.json or, with STORAGE_BACKEND=sqlite, as one row per changed guild"""
+
+    def __init__(self, path: str = config_path, flush_delay: float = 2.0, store=None, shared=None):
         self.path = path
+        self.flush_delay = flush_delay
+        self.data = None
+        self.lock = asyncio.Lock()
+        self._flush_task = None
+        self._store = store
+        self._shared = shared
+        self._dirty = set()
+        self._dirty_summaries = set()
+        # called with a guild id (or None for everything) whenever config changes
+        self.listeners = []
+
+    @property
+    def store(self):
+        # resolved lazily so the env from chatbot's load_dotenv is in place
+        if self._store is None:
+            self._store = storage.get_store() or False
+        return self._store
+
+    @property
+    def shared(self):
+        if self._shared is None:
+            self._shared = shared_state.get_shared_backend() or False
+        return self._shared
 
     def ensure_guild(self, data, guild_id: int):
         if "Guilds" not in data:
             data["Guilds"] = {}
         gid = str(guild_id)
         if gid not in data["Guilds"]:
-            data["Guilds"][gid] = self._default_guild()
+            # only the options a guild sets are stored, everything else follows the environment defaults
+            data["Guilds"][gid] = {}
         return data["Guilds"][gid]
 
     def _default_data(self):
@@ -49,55 +88,175 @@ class DB_Manager:
             "Guilds": {}
         }
 
-    def _default_guild(self):
-        return {
-            "max_history": 10,
-            "word_threshold": 500,
-            "set_channel": None,
-            "threads": False,
-            "statistics": False,
-            "display_model": True,
-            "safety": False,
-            "image_model": "gemini-2.0-flash-preview-image-generation",
-            "text_model": "gemini-2.0-flash"
-        }
-
     def file_exists(self):
         if not os.path.exists(self.path):
-            data = self._default_data()
-            with open(self.path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=4)
+            self._atomic_write(json.dumps(self._default_data(), indent=4))
+
+    def _read_file(self):
+        if self.store:
+            return {"Guilds": self.store.load_guilds(), "Summaries": self.store.load_summaries()}
 
-    def data_read(self):
         try:
             with open(self.path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                data = json.load(f)
         except FileNotFoundError:
             self.file_exists()
             return self._default_data()
         except json.JSONDecodeError:
+            os.replace(self.path, f"{self.path}.backup")
             return self._default_data()
 
-    def data_write(self, data):
+        data.setdefault("Guilds", {})
+        data.setdefault("Summaries", {})
+        return data
+
+    def _atomic_write(self, text: str):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".config-", suffix=".tmp")
         try:
-            directory = os.path.dirname(self.path)
-            if directory and not os.path.exists(directory):
-                os.makedirs(directory, exist_ok=True)
-            with open(self.path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=4)
-                return True
-
-        except (json.JSONDecodeError, FileNotFoundError):
-            if os.path.exists(self.path):
-                os.rename(self.path, f"{self.path}.backup")
-            with open(self.path, 'w', encoding='utf-8') as f:
-                json.dump(self._default_data(), f, indent=4)
-            return False
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def data_read(self):
+        if self.data is None:
+            self.data = self._read_file()
+        return self.data
+
+    async def load(self):
+        if self.data is None:
+            data = await asyncio.to_thread(self._read_file)
+            if self.data is None:
+                self.data = data
+        return self.data
+
+    async def reload_guilds(self, payload):
+        """Another process saved these guilds, re-read them unless this process has unflushed edits of its own"""
+        if not self.store or self.data is None:
+            return
+        for gid in payload.get("ids", []):
+            cfg = await asyncio.to_thread(self.store.load_guild, gid)
+            async with self.lock:
+                if gid in self._dirty:
+                    continue
+                if cfg is None:
+                    self.data["Guilds"].pop(gid, None)
+                else:
+                    self.data["Guilds"][gid] = cfg
+            self._notify(int(gid))
+
+    def _notify(self, guild_id=None):
+        for listener in self.listeners:
+            listener(guild_id)
 
+    def data_write(self, data):
+        self.data = data
+        self._dirty.update(data.get("Guilds", {}).keys())
+        self._notify()
+        self.schedule_flush()
+        return True
+
+    def get_guild(self, guild_id: int):
+        cfg = self.data_read()["Guilds"].get(str(guild_id))
+        return dict(cfg) if cfg is not None else {}
+
+    def has_guild(self, guild_id: int):
+        return str(guild_id) in self.data_read()["Guilds"]
+
+    async def update_guild(self, guild_id: int, changes: dict):
+        async with self.lock:
+            cfg = self.ensure_guild(self.data_read(), guild_id)
+            cfg.update(changes)
+            result = dict(cfg)
+            self._dirty.add(str(guild_id))
+        self._notify(guild_id)
+        self.schedule_flush()
+        return result
+
+    async def set_guild(self, guild_id: int, cfg: dict):
+        async with self.lock:
+            self.data_read()["Guilds"][str(guild_id)] = dict(cfg)
+            self._dirty.add(str(guild_id))
+        self._notify(guild_id)
+        self.schedule_flush()
+
+    def get_summary(self, channel_id: int):
+        return self.data_read().setdefault("Summaries", {}).get(str(channel_id))
+
+    async def set_summary(self, guild_id: int, channel_id: int, summary: str, last_message_id: int):
+        async with self.lock:
+            self.data_read().setdefault("Summaries", {})[str(channel_id)] = {
+                "guild_id": str(guild_id),
+                "summary": summary,
+                "last_message_id": last_message_id,
+            }
+            self._dirty_summaries.add(str(channel_id))
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # edits made while a flush is writing find this task still running and schedule nothing,
+        # so keep going until a flush leaves nothing dirty behind
+        while True:
+            await asyncio.sleep(self.flush_delay)
+            await self.flush()
+            if not self._dirty and not self._dirty_summaries:
+                return
+
+    async def flush(self):
+        if self.data is None:
+            return False
+        async with self.lock:
+            dirty, self._dirty = self._dirty, set()
+            dirty_summaries, self._dirty_summaries = self._dirty_summaries, set()
+            guilds = self.data["Guilds"]
+            summaries = self.data.setdefault("Summaries", {})
+            # guild configs and summaries are flat, a shallow copy per entry is a consistent snapshot
+            if self.store:
+                snapshot = {gid: dict(guilds[gid]) for gid in dirty if gid in guilds}
+                summary_snapshot = {cid: dict(summaries[cid]) for cid in dirty_summaries if cid in summaries}
+            else:
+                snapshot = {
+                    **self.data,
+                    "Guilds": {gid: dict(cfg) for gid, cfg in guilds.items()},
+                    "Summaries": {cid: dict(entry) for cid, entry in summaries.items()},
+                }
+        try:
+            if self.store:
+                if snapshot:
+                    await asyncio.to_thread(self.store.save_guilds, snapshot)
+                    if self.shared:
+                        self.shared.publish_nowait("guilds", {"ids": list(snapshot)})
+                if summary_snapshot:
+                    await asyncio.to_thread(self.store.save_summaries, summary_snapshot)
+            else:
+                await asyncio.to_thread(lambda: self._atomic_write(json.dumps(snapshot, indent=4)))
+            return True
         except Exception as e:
             print(f"Err: {e}")
+            async with self.lock:
+                self._dirty |= dirty
+                self._dirty_summaries |= dirty_summaries
             return False
 
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+db_manager = DB_Manager()
+settings.attach(db_manager)
+
 class ConfirmationView(discord.ui.View):
     def __init__(self, *, timeout=60):
         super().__init__(timeout=timeout)
@@ -131,7 +290,23 @@ class Discord_Commands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.tree = bot.tree
-        self.db_manager = DB_Manager()
+        self.db_manager = db_manager
+
+    async def cog_load(self):
+        await self.db_manager.load()
+        if self.db_manager.shared:
+            if not self.db_manager.store:
+                # whole-file config.json writes from several processes would overwrite each other
+                print("Warning: SHARED_BACKEND without STORAGE_BACKEND=sqlite, config edits stay per process")
+            self.db_manager.shared.subscribe("guilds", self.db_manager.reload_guilds)
+
+    async def cog_unload(self):
+        await self.db_manager.close()
+
+    @staticmethod
+    def effective_config(guild_id: int):
+        """Stored options over the environment defaults, in the shape config_import accepts"""
+        return {k: v for k, v in settings.resolve(guild_id).items() if k in config_schema["properties"]}
 
     async def config_option_autocomplete(self, interaction: discord.Interaction, current: str):
         current_l = (current or "").lower()
@@ -142,9 +317,8 @@ class Discord_Commands(commands.Cog):
     async def config_export(self, interaction: discord.Interaction):
         await interaction.response.defer(thinking=True, ephemeral=True)
 
-        data = self.db_manager.data_read()
         guild_id = str(interaction.guild.id)
-        guild_cfg = data["Guilds"].get(guild_id, self.db_manager._default_guild())
+        guild_cfg = self.effective_config(interaction.guild.id)
         json_bytes = json.dumps(guild_cfg, indent=2).encode()
 
         file = discord.File(io.BytesIO(json_bytes), filename=f"{guild_id}_config.json")
@@ -166,9 +340,7 @@ class Discord_Commands(commands.Cog):
             )
             
             if confirmed is True:
-                data = self.db_manager.data_read()
-                data["Guilds"][str(interaction.guild.id)] = new_cfg
-                self.db_manager.data_write(data)
+                await self.db_manager.set_guild(interaction.guild.id, new_cfg)
                 await interaction.followup.send("Config imported successfully.", ephemeral=True)
             elif confirmed is False:
                 await interaction.followup.send("Import cancelled.")
@@ -188,18 +360,16 @@ class Discord_Commands(commands.Cog):
     async def config_edit(self, interaction: discord.Interaction, option: str, value: str):
         await interaction.response.send_message(f"{interaction.user.mention} Editing config...")
         guild_id = interaction.guild.id if interaction.guild else 0
-        data = self.db_manager.data_read()
-        cfg = self.db_manager.ensure_guild(data, guild_id)
 
         try:
             if option in SETTINGS["INT"]:
-                cfg[option] = max(0, int(value))
+                new_value = settings.clamp(option, max(0, int(value)))
 
             elif option in SETTINGS["BOOL"]:
-                cfg[option] = value.lower() in ("1", "true", "yes", "on")
+                new_value = value.lower() in ("1", "true", "yes", "on")
 
             elif option in SETTINGS["STR"]:
-                cfg[option] = value
+                new_value = value
 
             else:
                 await interaction.followup.send("Unknown setting.")
@@ -213,15 +383,17 @@ class Discord_Commands(commands.Cog):
             await interaction.followup.send(f"Error: {e}.")
             return
 
-        self.db_manager.data_write(data)
-        await interaction.followup.send(f"Updated {option}.")
+        await self.db_manager.update_guild(guild_id, {option: new_value})
+        if option in SETTINGS["INT"] and str(new_value) != value.strip():
+            await interaction.followup.send(f"Updated {option} to {new_value}.")
+        else:
+            await interaction.followup.send(f"Updated {option}.")
 
     @app_commands.command(name="config", description="Display current config")
     async def config_display(self, interaction: discord.Interaction):
         await interaction.response.defer(thinking=True, ephemeral=False)
         guild_id = interaction.guild.id if interaction.guild else 0
-        data = self.db_manager.data_read()
-        cfg = self.db_manager.ensure_guild(data, guild_id)
+        cfg = self.effective_config(guild_id)
 
         embed = discord.Embed(title="Server Config:", color=0x00BFFF)
 
@@ -238,9 +410,8 @@ class Discord_Commands(commands.Cog):
     async def reset_config(self, interaction: discord.Interaction) -> None:
         await interaction.response.defer(thinking=True)
         guild_id = interaction.guild.id if interaction.guild else 0
-        data = self.db_manager.data_read()
         
-        if str(guild_id) not in data["Guilds"]:
+        if not self.db_manager.has_guild(guild_id):
             await interaction.followup.send("No config found for this server.")
             return
         
@@ -251,8 +422,7 @@ class Discord_Commands(commands.Cog):
         )
         
         if confirmed is True:
-            data["Guilds"][str(guild_id)] = self.db_manager._default_guild()
-            self.db_manager.data_write(data)
+            await self.db_manager.set_guild(guild_id, {})
             await interaction.followup.send("Config has been reset to defaults.")
         elif confirmed is False:
             await interaction.followup.send("Reset cancelled.")
@@ -0,0 +1,73 @@
+from lazy_imports import lazy_module
+
+types = lazy_module("google.genai.types")
+
+
+class TokenEstimator:
+    """Local chars-per-token estimate, calibrated from the usage metadata Gemini returns with each reply"""
+
+    def __init__(self, chars_per_token: float = 4.0, smoothing: float = 0.2):
+        self.chars_per_token = chars_per_token
+        self.smoothing = smoothing
+
+    def estimate(self, text: str) -> int:
+        return int(len(text) / self.chars_per_token) + 1
+
+    def observe(self, chars: int, tokens):
+        if not tokens or chars <= 0:
+            return
+        ratio = min(max(chars / tokens, 1.0), 8.0)
+        self.chars_per_token += self.smoothing * (ratio - self.chars_per_token)
+
+
+class ContextBuilder:
+    def __init__(self, token_budget: int = 1500, estimator: TokenEstimator = None):
+        self.token_budget = token_budget
+        self.estimator = estimator or TokenEstimator()
+
+    def pack_history(self, history, budget: int):
+        """Newest-first packing of history entries into budget tokens, returned oldest first as 'name: content' lines"""
+        lines, seen, used = [], set(), 0
+
+        for entry in reversed(history):
+            content = (entry.get("content") or "").strip()
+            # attachment-only and embed-only messages carry no text for the model
+            if not content:
+                continue
+            key = (entry.get("author_id"), content)
+            if key in seen:
+                continue
+            line = f"{entry['author']}: {content}"
+            cost = self.estimator.estimate(line)
+            if used + cost > budget:
+                break
+            seen.add(key)
+            lines.append(line)
+            used += cost
+
+        lines.reverse()
+        return lines
+
+    def build(self, prompt: str, history, image: "types.Part" = None, summary: str = None, token_budget: int = None):
+        budget = token_budget or self.token_budget
+        prompt = prompt or ("What is in this image?" if image else "(you were mentioned without a message)")
+        budget -= self.estimator.estimate(prompt)
+
+        parts = []
+        if summary:
+            summary_text = f"Summary of earlier conversation in this channel:\n{summary}"
+            budget -= self.estimator.estimate(summary_text)
+            parts.append(types.Part.from_text(text=summary_text))
+
+        lines = self.pack_history(history, max(budget, 0))
+        if lines:
+            parts.append(types.Part.from_text(text="Recent channel messages:\n" + "\n".join(lines)))
+        if image is not None:
+            parts.append(image)
+        parts.append(types.Part.from_text(text=f"User: {prompt}"))
+
+        return [types.Content(role="user", parts=parts)]
+
+    @staticmethod
+    def text_length(contents) -> int:
+        return sum(len(part.text or "") for content in contents for part in content.parts)
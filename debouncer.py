@@ -0,0 +1,84 @@
+import asyncio
+
+
+class _Pending:
+    def __init__(self):
+        self.messages = []
+        self.timer = None
+        self.running = None
+        self.size = 0
+
+
+class MessageDebouncer:
+    """Collects bursts of messages per (channel, author) and hands them to the handler as one batch.
+
+    Each new message restarts the window. A message that arrives while the previous batch is still
+    generating cancels that generation and is merged with it, so only the latest batch gets answered.
+    Once the handler calls sending() its reply is going out and is left to finish, later messages
+    then make up a batch of their own."""
+
+    def __init__(self, window: float = 2.0, max_messages: int = 8):
+        self.window = window
+        self.max_messages = max_messages
+        self.pending = {}
+        self.batches = 0
+        self.merged = 0
+        self.superseded = 0
+
+    def submit(self, message, handler):
+        key = (message.channel.id, message.author.id)
+        state = self.pending.setdefault(key, _Pending())
+
+        if state.running is not None and not state.running.done():
+            state.running.cancel()
+            self.superseded += 1
+        if state.timer is not None:
+            state.timer.cancel()
+            self.merged += 1
+
+        state.messages.append(message)
+        delay = 0 if len(state.messages) >= self.max_messages else self.window
+        state.timer = asyncio.create_task(self._fire(key, state, handler, delay))
+
+    async def _fire(self, key, state, handler, delay):
+        await asyncio.sleep(delay)
+
+        batch = list(state.messages)
+        state.timer = None
+        state.running = asyncio.current_task()
+        state.size = len(batch)
+        self.batches += 1
+        try:
+            await handler(batch)
+        except asyncio.CancelledError:
+            # superseded, the batch stays pending and goes out merged with the next one
+            raise
+        except Exception as e:
+            print(f"Batch error: {e}")
+
+        if state.running is asyncio.current_task():
+            self._commit(state)
+        if not state.messages and state.timer is None and self.pending.get(key) is state:
+            del self.pending[key]
+
+    def sending(self):
+        """Called from the handler before it starts posting its reply, so a newer message can't cancel it half-posted"""
+        task = asyncio.current_task()
+        for state in self.pending.values():
+            if state.running is task:
+                self._commit(state)
+                return
+
+    @staticmethod
+    def _commit(state):
+        state.running = None
+        del state.messages[:state.size]
+        state.size = 0
+
+    def stats(self):
+        return {
+            "pending": len(self.pending),
+            "batches": self.batches,
+            "merged": self.merged,
+            "superseded": self.superseded,
+        }
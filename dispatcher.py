@@ -0,0 +1,103 @@
+import asyncio
+
+import discord
+
+DISCORD_LIMIT = 2000
+# room for closing a code fence at the end of a chunk and reopening it at the start of the next
+FENCE_RESERVE = 24
+
+
+def _split_boundaries(text: str, limit: int):
+    parts = []
+    while len(text) > limit:
+        window = text[:limit]
+        for sep in ("\n\n", "\n", " "):
+            cut = window.rfind(sep)
+            # don't accept a boundary that would leave a tiny chunk
+            if cut > limit // 4:
+                cut += len(sep)
+                break
+        else:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:]
+    parts.append(text)
+    return [part for part in parts if part.strip()]
+
+
+def split_message(text: str, limit: int = DISCORD_LIMIT):
+    """Splits on paragraph, then line, then word boundaries, closing and reopening ``` fences across chunks"""
+    chunks = []
+    fence = None
+
+    for part in _split_boundaries(text, limit - FENCE_RESERVE):
+        opened = fence
+
+        for line in part.splitlines():
+            stripped = line.strip()
+            if stripped.startswith("```"):
+                fence = None if fence else (stripped if len(stripped) <= FENCE_RESERVE // 2 else "```")
+
+        if opened:
+            part = f"{opened}\n{part}"
+        if fence:
+            part += "\n```"
+        chunks.append(part)
+
+    return chunks
+
+
+class OutboundDispatcher:
+    """One send queue per channel so long answers go out in order, paced by discord.py's rate-limit buckets"""
+
+    def __init__(self, limit: int = DISCORD_LIMIT, idle_timeout: float = 30.0):
+        self.limit = limit
+        self.idle_timeout = idle_timeout
+        self.queues = {}
+
+    async def send(self, channel, text: str):
+        chunks = split_message(text, self.limit)
+        fut = asyncio.get_running_loop().create_future()
+
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = asyncio.Queue()
+            asyncio.create_task(self._worker(channel.id, queue))
+        queue.put_nowait((channel, chunks, fut))
+        return await fut
+
+    async def _worker(self, channel_id, queue: asyncio.Queue):
+        while True:
+            try:
+                channel, chunks, fut = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self.queues[channel_id]
+                    return
+                continue
+
+            sent = []
+            try:
+                for chunk in chunks:
+                    sent.append(await self._send_one(channel, chunk))
+                if not fut.done():
+                    fut.set_result(sent)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+
+    @staticmethod
+    async def _send_one(channel, content: str):
+        # discord.py already waits on X-RateLimit-Remaining/Reset-After and retries 429s,
+        # RateLimited only surfaces when the wait would exceed max_ratelimit_timeout
+        while True:
+            try:
+                return await channel.send(content)
+            except discord.RateLimited as e:
+                await asyncio.sleep(e.retry_after)
+
+    def stats(self):
+        return {
+            "channels": len(self.queues),
+            "pending": sum(queue.qsize() for queue in self.queues.values()),
+        }
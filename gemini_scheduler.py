@@ -0,0 +1,79 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+
+class _Lane:
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.active = 0
+        # guild_id -> deque of waiting futures, iterated round-robin
+        self.waiters: "OrderedDict[int, deque]" = OrderedDict()
+
+    def waiting(self):
+        return sum(len(q) for q in self.waiters.values())
+
+
+class GeminiScheduler:
+    """Bounds concurrent Gemini calls per kind and hands free slots to guilds round-robin"""
+
+    def __init__(self, limits: dict):
+        self.lanes = {kind: _Lane(limit) for kind, limit in limits.items()}
+
+    async def run(self, kind: str, guild_id, factory):
+        async with self.slot(kind, guild_id):
+            return await factory()
+
+    @asynccontextmanager
+    async def slot(self, kind: str, guild_id):
+        """Holds one slot for the whole block, for calls that outlive a single await such as streams"""
+        lane = self.lanes[kind]
+        await self._acquire(lane, guild_id or 0)
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    async def _acquire(self, lane: _Lane, guild_id: int):
+        if lane.active < lane.limit and not lane.waiters:
+            lane.active += 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        lane.waiters.setdefault(guild_id, deque()).append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # slot was handed to us right as we got cancelled, pass it on
+                self._release(lane)
+            else:
+                queue = lane.waiters.get(guild_id)
+                if queue and fut in queue:
+                    queue.remove(fut)
+                    if not queue:
+                        del lane.waiters[guild_id]
+            raise
+
+    def _release(self, lane: _Lane):
+        while lane.waiters:
+            guild_id, queue = lane.waiters.popitem(last=False)
+            fut = queue.popleft()
+            if queue:
+                lane.waiters[guild_id] = queue
+            if not fut.done():
+                # slot stays taken, ownership moves to the next guild in line
+                fut.set_result(None)
+                return
+        lane.active -= 1
+
+    def has_capacity(self, kind: str) -> bool:
+        """A call of this kind would start right away"""
+        lane = self.lanes[kind]
+        return lane.active < lane.limit and not lane.waiters
+
+    def stats(self):
+        return {
+            kind: {"active": lane.active, "limit": lane.limit, "waiting": lane.waiting()}
+            for kind, lane in self.lanes.items()
+        }
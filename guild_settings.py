@@ -0,0 +1,55 @@
+class SettingsResolver:
+    """Effective per-guild settings: stored guild config over environment defaults, cached until the guild is edited.
+
+    Lives outside config_manager because discord.py re-executes extension modules on load,
+    the cog attaches its DB_Manager here instead."""
+
+    def __init__(self, defaults: dict = None):
+        self.defaults = dict(defaults or {})
+        # upper bounds for numeric options, e.g. max_history can't outgrow the history cache
+        self.limits = {}
+        self.db_manager = None
+        self.cache = {}
+
+    def attach(self, db_manager):
+        self.db_manager = db_manager
+        db_manager.listeners.append(self.invalidate)
+        self.cache.clear()
+
+    def set_defaults(self, defaults: dict):
+        self.defaults = dict(defaults)
+        self.cache.clear()
+
+    def set_limits(self, limits: dict):
+        self.limits = dict(limits)
+        self.cache.clear()
+
+    def clamp(self, option: str, value):
+        limit = self.limits.get(option)
+        return value if limit is None or value is None else min(value, limit)
+
+    def resolve(self, guild_id) -> dict:
+        guild_id = guild_id or 0
+        cached = self.cache.get(guild_id)
+        if cached is not None:
+            return cached
+
+        effective = dict(self.defaults)
+        if self.db_manager is not None and self.db_manager.has_guild(guild_id):
+            # unset values (e.g. set_channel: null) fall back to the environment
+            effective.update({k: v for k, v in self.db_manager.get_guild(guild_id).items() if v is not None})
+        for option in self.limits:
+            if option in effective:
+                effective[option] = self.clamp(option, effective[option])
+
+        self.cache[guild_id] = effective
+        return effective
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(int(guild_id), None)
+
+
+settings = SettingsResolver()
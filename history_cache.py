@@ -0,0 +1,101 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+
+class _ChannelBuffer:
+    def __init__(self, size: int):
+        self.messages = deque(maxlen=size)
+        self.backfilled = False
+        self.last_seen = time.monotonic()
+        self.lock = asyncio.Lock()
+
+
+class ChannelHistoryCache:
+    """Per-channel ring buffer of recent messages, kept warm from gateway events"""
+
+    def __init__(self, max_messages: int = 50, max_channels: int = 500, idle_seconds: int = 3600):
+        self.max_messages = max_messages
+        self.max_channels = max_channels
+        self.idle_seconds = idle_seconds
+        self.channels: "OrderedDict[int, _ChannelBuffer]" = OrderedDict()
+
+    def _touch(self, channel_id: int) -> _ChannelBuffer:
+        buf = self.channels.get(channel_id)
+        if buf is None:
+            buf = _ChannelBuffer(self.max_messages)
+            self.channels[channel_id] = buf
+        else:
+            self.channels.move_to_end(channel_id)
+        buf.last_seen = time.monotonic()
+        self._evict()
+        return buf
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        while self.channels:
+            channel_id, oldest = next(iter(self.channels.items()))
+            if len(self.channels) <= self.max_channels and oldest.last_seen >= cutoff:
+                break
+            del self.channels[channel_id]
+
+    @staticmethod
+    def _entry(message):
+        return {
+            "id": message.id,
+            "author": message.author.display_name,
+            "author_id": message.author.id,
+            "content": message.content,
+        }
+
+    def add(self, message):
+        buf = self._touch(message.channel.id)
+        if buf.messages and buf.messages[-1]["id"] >= message.id:
+            # out of order delivery, fall back to a sorted merge
+            self._merge(buf, [self._entry(message)])
+        else:
+            buf.messages.append(self._entry(message))
+
+    def edit(self, channel_id: int, message_id: int, content: str):
+        buf = self.channels.get(channel_id)
+        if buf is None:
+            return
+        for entry in buf.messages:
+            if entry["id"] == message_id:
+                entry["content"] = content
+                return
+
+    def delete(self, channel_id: int, message_id: int):
+        buf = self.channels.get(channel_id)
+        if buf is None:
+            return
+        for entry in buf.messages:
+            if entry["id"] == message_id:
+                buf.messages.remove(entry)
+                return
+
+    def _merge(self, buf: _ChannelBuffer, entries):
+        merged = {entry["id"]: entry for entry in entries}
+        # live entries win over backfilled ones, they carry the latest edits
+        merged.update({entry["id"]: entry for entry in buf.messages})
+        buf.messages.clear()
+        buf.messages.extend(sorted(merged.values(), key=lambda e: e["id"])[-self.max_messages:])
+
+    async def recent(self, channel, limit: int):
+        """Returns up to `limit` most recent entries, oldest first. REST is only hit once per cold channel"""
+        buf = self._touch(channel.id)
+        if not buf.backfilled:
+            async with buf.lock:
+                if not buf.backfilled:
+                    fetched = [self._entry(msg) async for msg in channel.history(limit=self.max_messages)]
+                    self._merge(buf, fetched)
+                    buf.backfilled = True
+        if limit <= 0:
+            return []
+        return list(buf.messages)[-limit:]
+
+    def stats(self):
+        return {
+            "channels": len(self.channels),
+            "messages": sum(len(buf.messages) for buf in self.channels.values()),
+        }
@@ -0,0 +1,97 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
+
+# discord signs attachment urls with expiring query params, the path alone identifies the file
+SIGNED_URL_HOSTS = {"cdn.discordapp.com", "media.discordapp.net"}
+
+
+class ImageEntry:
+    def __init__(self, digest: str, image_bytes: bytes, mime_type: str):
+        self.digest = digest
+        self.image_bytes = image_bytes
+        self.mime_type = mime_type
+        self.description: Optional[str] = None
+        self.created_at = time.monotonic()
+
+
+class ImageCache:
+    """Content-addressed LRU/TTL cache of preprocessed images, with url aliases pointing at digests"""
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024, ttl: int = 6 * 3600):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, ImageEntry]" = OrderedDict()
+        self.urls: "OrderedDict[str, str]" = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_url(url: str) -> str:
+        parts = urlsplit(url)
+        if parts.hostname in SIGNED_URL_HOSTS:
+            parts = parts._replace(query="", fragment="")
+        return urlunsplit(parts)
+
+    def _expired(self, entry: ImageEntry) -> bool:
+        return time.monotonic() - entry.created_at > self.ttl
+
+    def get(self, digest: str) -> Optional[ImageEntry]:
+        entry = self.entries.get(digest)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            self._drop(digest)
+            return None
+        self.entries.move_to_end(digest)
+        return entry
+
+    def get_by_url(self, url: str) -> Optional[ImageEntry]:
+        key = self.normalize_url(url)
+        digest = self.urls.get(key)
+        entry = self.get(digest) if digest else None
+        if entry is None:
+            self.urls.pop(key, None)
+            self.misses += 1
+            return None
+        self.urls.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, url: str, digest: str, image_bytes: bytes, mime_type: str) -> ImageEntry:
+        entry = self.get(digest)
+        if entry is None:
+            entry = ImageEntry(digest, image_bytes, mime_type)
+            self.entries[digest] = entry
+            self.total_bytes += len(image_bytes)
+        else:
+            # same picture under a new url, keep the description we already paid for
+            self.hits += 1
+
+        key = self.normalize_url(url)
+        self.urls[key] = digest
+        self.urls.move_to_end(key)
+        self._evict()
+        return entry
+
+    def _drop(self, digest: str):
+        entry = self.entries.pop(digest, None)
+        if entry is not None:
+            self.total_bytes -= len(entry.image_bytes)
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self._drop(next(iter(self.entries)))
+        while len(self.urls) > self.max_entries * 4:
+            self.urls.popitem(last=False)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,61 @@
+import asyncio
+import hashlib
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+FORMATS = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+
+def preprocess_image(raw: bytes, max_edge: int = 1024, fmt: str = "JPEG", quality: int = 85):
+    """Decodes the first frame, flattens it to RGB, downscales to max_edge and re-encodes it. Runs off the event loop.
+    Returns (bytes, mime_type, digest) where digest hashes the decoded pixels, so re-uploads of the same picture match"""
+    from PIL import Image
+
+    with Image.open(BytesIO(raw)) as img:
+        # animated GIF/WebP: only the first frame goes to the model
+        if getattr(img, "is_animated", False):
+            img.seek(0)
+
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            rgba = img.convert("RGBA")
+            frame = Image.new("RGB", rgba.size, (255, 255, 255))
+            frame.paste(rgba, mask=rgba.getchannel("A"))
+        elif img.mode != "RGB":
+            frame = img.convert("RGB")
+        else:
+            frame = img.copy()
+
+    if max_edge and max(frame.size) > max_edge:
+        frame.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    digest = hashlib.sha256(frame.tobytes()).hexdigest()
+
+    out = BytesIO()
+    frame.save(out, format=fmt, quality=quality, optimize=True)
+    return out.getvalue(), FORMATS[fmt], digest
+
+
+class ImagePipeline:
+    def __init__(self, max_edge: int = 1024, fmt: str = "JPEG", quality: int = 85, workers: int = 2, use_processes: bool = False):
+        fmt = fmt.upper()
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported image format: {fmt}")
+        self.max_edge = max_edge
+        self.fmt = fmt
+        self.quality = quality
+        self.executor: Executor = (
+            ProcessPoolExecutor(max_workers=workers) if use_processes
+            else ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        )
+
+    async def process(self, raw: bytes):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, preprocess_image, raw, self.max_edge, self.fmt, self.quality
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
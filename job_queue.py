@@ -0,0 +1,236 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+import uuid
+
+ACTIVE = ("queued", "running")
+
+
+class Job:
+    FIELDS = ("id", "kind", "prompt", "guild_id", "channel_id", "user_id", "message_id",
+              "status", "created_at", "deadline", "attempts", "error")
+
+    def __init__(self, kind, prompt, guild_id, channel_id, user_id, deadline, **extra):
+        self.id = extra.get("id") or uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.prompt = prompt
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.message_id = extra.get("message_id")
+        self.status = extra.get("status", "queued")
+        self.created_at = extra.get("created_at", time.time())
+        self.deadline = deadline
+        self.attempts = extra.get("attempts", 0)
+        self.error = extra.get("error")
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        return cls(data.pop("kind"), data.pop("prompt"), data.pop("guild_id"), data.pop("channel_id"),
+                   data.pop("user_id"), data.pop("deadline"), **data)
+
+
+class JobStore:
+    """Job records in the SQLiteStore when there is one, otherwise in jobs.json. Finished jobs are removed"""
+
+    def __init__(self, store=None, path: str = "jobs.json"):
+        self.store = store
+        self.path = path
+        self.jobs = {}
+        # one write at a time, so an older snapshot can never land after a newer one
+        self._lock = asyncio.Lock()
+
+    def _write_file(self, records):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".jobs-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(records, f, indent=2)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _load(self):
+        if self.store:
+            return self.store.load_jobs()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return []
+
+    async def load(self):
+        records = await asyncio.to_thread(self._load)
+        self.jobs = {record["id"]: record for record in records if record.get("status") in ACTIVE}
+        return [Job.from_dict(record) for record in self.jobs.values()]
+
+    async def save(self, job: Job):
+        if job.status in ACTIVE:
+            self.jobs[job.id] = job.to_dict()
+        else:
+            self.jobs.pop(job.id, None)
+
+        async with self._lock:
+            if self.store:
+                if job.status in ACTIVE:
+                    await asyncio.to_thread(self.store.save_job, job.to_dict())
+                else:
+                    await asyncio.to_thread(self.store.delete_job, job.id)
+            else:
+                await asyncio.to_thread(self._write_file, list(self.jobs.values()))
+
+
+class JobQueue:
+    """Durable background jobs with a worker pool per kind, per-job deadlines and cancellation.
+
+    handlers[kind](job) does the work and returns a result, deliver(job, result) posts it. deliver is also
+    called with result None when a worker picks the job up (status running) and for jobs that end
+    cancelled, failed or expired, so the status can be updated.
+    Jobs that were queued or running when the process stopped are picked up again by start()"""
+
+    def __init__(self, store: JobStore, handlers: dict, deliver, workers: dict, deadlines: dict, max_attempts: int = 3):
+        self.store = store
+        self.handlers = handlers
+        self.deliver = deliver
+        self.workers = workers
+        self.deadlines = deadlines
+        self.max_attempts = max_attempts
+        self.queues = {kind: asyncio.Queue() for kind in handlers}
+        self.jobs = {}
+        self.running = {}
+        self._tasks = []
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self, owns=lambda job: True):
+        """Resumes stored jobs this process is responsible for (see owns) and starts the workers"""
+        for job in await self.store.load():
+            if not owns(job):
+                continue
+            self.jobs[job.id] = job
+            job.status = "queued"
+            self.queues[job.kind].put_nowait(job)
+        for kind, count in self.workers.items():
+            for _ in range(count):
+                self._tasks.append(asyncio.get_running_loop().create_task(self._worker(kind)))
+
+    def new_job(self, kind, prompt, guild_id, channel_id, user_id) -> Job:
+        """A job that isn't queued yet, so its id can go into the status message before submit()"""
+        return Job(kind, prompt, guild_id, channel_id, user_id, time.time() + self.deadlines.get(kind, 600))
+
+    async def submit(self, job: Job) -> Job:
+        self.jobs[job.id] = job
+        await self.store.save(job)
+        self.queues[job.kind].put_nowait(job)
+        return job
+
+    def pending(self, kind: str) -> int:
+        return sum(1 for job in self.jobs.values() if job.kind == kind and job.status == "queued")
+
+    async def cancel(self, job_id: str, user_id=None) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.status not in ACTIVE:
+            return False
+        if user_id is not None and job.user_id != user_id:
+            return False
+        task = self.running.get(job_id)
+        if task is not None:
+            # the worker finishes the bookkeeping
+            task.cancel()
+            job.status = "cancelled"
+            return True
+        await self._finish(job, "cancelled")
+        return True
+
+    async def _save(self, job: Job):
+        try:
+            await self.store.save(job)
+        except Exception as e:
+            print(f"Job save error ({job.id}): {e}")
+
+    async def _deliver(self, job: Job, result=None):
+        try:
+            await self.deliver(job, result)
+        except Exception as e:
+            print(f"Job delivery error ({job.id}): {e}")
+
+    async def _finish(self, job: Job, status: str, result=None, error: str = None):
+        job.status = status
+        job.error = error
+        self.jobs.pop(job.id, None)
+        # a failed write must not cost the user their result
+        await self._save(job)
+        await self._deliver(job, result)
+
+    async def _worker(self, kind):
+        while True:
+            job = await self.queues[kind].get()
+            try:
+                await self._run(kind, job)
+            except Exception as e:
+                # whatever went wrong, the worker has to stay alive for the next job
+                print(f"Job worker error ({job.id}): {e}")
+                if job.status in ACTIVE:
+                    self.failed += 1
+                    await self._finish(job, "failed", error=str(e))
+
+    async def _run(self, kind, job: Job):
+        if job.status != "queued":
+            return
+
+        remaining = job.deadline - time.time()
+        if remaining <= 0:
+            await self._finish(job, "expired", error="deadline passed before the job started")
+            return
+        if job.attempts >= self.max_attempts:
+            self.failed += 1
+            await self._finish(job, "failed", error="too many attempts")
+            return
+
+        job.status = "running"
+        job.attempts += 1
+        await self.store.save(job)
+        await self._deliver(job)
+
+        task = asyncio.get_running_loop().create_task(self.handlers[kind](job))
+        self.running[job.id] = task
+        try:
+            result = await asyncio.wait_for(task, remaining)
+        except asyncio.CancelledError:
+            if job.status == "cancelled":
+                await self._finish(job, "cancelled")
+                return
+            raise
+        except asyncio.TimeoutError:
+            self.failed += 1
+            await self._finish(job, "expired", error="deadline exceeded")
+        except Exception as e:
+            self.failed += 1
+            await self._finish(job, "failed", error=str(e))
+        else:
+            self.completed += 1
+            await self._finish(job, "done", result)
+        finally:
+            self.running.pop(job.id, None)
+
+    async def close(self):
+        """Stops the workers. Unfinished jobs keep their stored status and are resumed on the next start"""
+        for task in self._tasks:
+            task.cancel()
+        for task in list(self.running.values()):
+            task.cancel()
+
+    def stats(self):
+        return {
+            "queued": {kind: queue.qsize() for kind, queue in self.queues.items()},
+            "running": len(self.running),
+            "completed": self.completed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,25 @@
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module and imports it on first attribute access.
+
+    Keeps heavy SDKs (google.genai alone takes most of a second) off the startup path
+    until the first request actually needs them"""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self._module = None
+
+    def __getattr__(self, attr):
+        # only reached for names not already copied into this proxy
+        if self._module is None:
+            self._module = importlib.import_module(self.__name__)
+        value = getattr(self._module, attr)
+        self.__dict__[attr] = value
+        return value
+
+
+def lazy_module(name: str) -> LazyModule:
+    return LazyModule(name)
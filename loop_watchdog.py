@@ -0,0 +1,136 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from metrics import registry
+
+LOOP_LAG = registry.histogram(
+    "bot_loop_lag_seconds", "Event loop wakeup delay", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+STALLS = registry.counter("bot_loop_stalls_total", "Event loop stalls over the watchdog threshold")
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def collapse(frame) -> str:
+    """Root-first "file:function;file:function" line as used by flamegraph.pl and speedscope"""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+class LoopWatchdog:
+    """Heartbeat on the loop plus a thread watching it. When the heartbeat is late by more than threshold,
+    the thread logs what the loop thread is executing right now (task and stack), while it's still stuck"""
+
+    def __init__(self, threshold: float = 0.25, interval: float = 0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.stalls = 0
+        self._reported = None
+        self._heartbeat = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._stop.clear()
+        self._heartbeat = self.loop.create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def _beat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last_beat = now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                print(f"Event loop stalled for {lag * 1000:.0f}ms")
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            beat = self.last_beat
+            if time.monotonic() - beat < self.threshold + self.interval or self._reported == beat:
+                continue
+            # one report per stall, the heartbeat logs the total once the loop is back
+            self._reported = beat
+            self.stalls += 1
+            STALLS.inc()
+            self._report(time.monotonic() - beat - self.interval)
+
+    def _report(self, stalled_for: float):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        task = asyncio.current_task(self.loop)
+        name = task.get_name() if task else "no task (callback or loop internals)"
+        coro = getattr(task.get_coro(), "__qualname__", "") if task else ""
+        stack = "".join(traceback.format_stack(frame)) if frame else "  (no frame)\n"
+        print(f"Event loop blocked for over {stalled_for * 1000:.0f}ms in {name} {coro}\n{stack}", end="")
+
+    async def stop(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+
+
+class SamplingProfiler:
+    """Samples every thread's stack from a background thread and aggregates collapsed stacks.
+    Cheap enough to leave on for a few minutes in production, off by default"""
+
+    def __init__(self, interval: float = 0.005, max_seconds: float = 300):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.samples = Counter()
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return False
+        self.samples = Counter()
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def _sample(self):
+        own = threading.get_ident()
+        deadline = self.started_at + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                self.samples[f"{names.get(thread_id, thread_id)};{collapse(frame)}"] += 1
+
+    def stop(self) -> str:
+        """Stops sampling and returns the collapsed stacks, one "stack count" per line"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
@@ -0,0 +1,218 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels: dict):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (k + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for k, v in pairs)
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels):
+        self.values[_label_key(labels)] += value
+
+    def get(self, **labels) -> float:
+        return self.values.get(_label_key(labels), 0.0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for key, value in self.values.items():
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Histogram:
+    """Prometheus-style cumulative buckets, plus a small window of raw samples for percentiles"""
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS, window: int = 512):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.window = window
+        self.series = {}
+
+    def _series(self, key):
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = {
+                "counts": [0] * (len(self.buckets) + 1),
+                "sum": 0.0,
+                "count": 0,
+                "samples": deque(maxlen=self.window),
+            }
+        return series
+
+    def observe(self, value: float, **labels):
+        series = self._series(_label_key(labels))
+        series["counts"][bisect_left(self.buckets, value)] += 1
+        series["sum"] += value
+        series["count"] += 1
+        series["samples"].append(value)
+
+    def count(self, **labels) -> int:
+        series = self.series.get(_label_key(labels))
+        return series["count"] if series else 0
+
+    def percentile(self, q: float, **labels):
+        """q in [0, 1] over the recent window, None without samples"""
+        series = self.series.get(_label_key(labels))
+        if not series or not series["samples"]:
+            return None
+        ordered = sorted(series["samples"])
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summaries(self):
+        """(labels, count, p50, p99) per label set, for human readable output"""
+        for key in list(self.series):
+            labels = dict(key)
+            yield labels, self.series[key]["count"], self.percentile(0.5, **labels), self.percentile(0.99, **labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(key, [('le', str(bound))])} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series['count']}"
+            yield f"{self.name}_sum{_format_labels(key)} {series['sum']}"
+            yield f"{self.name}_count{_format_labels(key)} {series['count']}"
+
+
+class Gauge:
+    """Read at scrape time from a callback returning a number or a list of (labels, value)"""
+
+    def __init__(self, name: str, help: str, fn):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def samples(self):
+        value = self.fn()
+        if isinstance(value, (int, float)):
+            return [({}, value)]
+        return value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.samples():
+            yield f"{self.name}{_format_labels(_label_key(labels))} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, fn) -> Gauge:
+        self.metrics[name] = Gauge(name, help, fn)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# error rendering {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+def flatten_stats(sources: dict):
+    """Turns {component: stats()} into gauge samples labelled by component and field.
+    Nested dicts (per lane, per reason) are joined with dots"""
+    samples = []
+
+    def walk(component, prefix, values):
+        for field, value in values.items():
+            name = f"{prefix}.{field}" if prefix else str(field)
+            if isinstance(value, dict):
+                walk(component, name, value)
+            elif isinstance(value, (int, float)):
+                samples.append(({"component": component, "field": name}, value))
+
+    for component, source in sources.items():
+        walk(component, "", source())
+    return samples
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram("bot_stage_seconds", "Time spent per pipeline stage")
+ERRORS = registry.counter("bot_errors_total", "Errors per pipeline stage")
+TOKENS = registry.counter("bot_gemini_tokens_total", "Gemini tokens by model and direction")
+REQUESTS = registry.counter("bot_gemini_requests_total", "Gemini calls by kind and model")
+COMMANDS = registry.counter("bot_commands_total", "Completed slash commands")
+
+
+@contextmanager
+def span(stage: str, **labels):
+    """Times a stage into bot_stage_seconds and counts exceptions escaping it"""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        # cancellation is flow control, not an error
+        if not isinstance(e, GeneratorExit) and type(e).__name__ != "CancelledError":
+            ERRORS.inc(stage=stage, error=type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage, **labels)
+
+
+def record_usage(kind: str, model: str, response):
+    REQUESTS.inc(kind=kind, model=model)
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    for direction, field in (("input", "prompt_token_count"), ("output", "candidates_token_count"),
+                             ("cached", "cached_content_token_count")):
+        count = getattr(usage, field, None)
+        if count:
+            TOKENS.inc(count, model=model, direction=direction)
+
+
+async def tracked(kind: str, model: str, call):
+    """Awaits a Gemini call, timing it as the "gemini" stage and counting its tokens"""
+    with span("gemini", kind=kind):
+        response = await call
+    record_usage(kind, model, response)
+    return response
+
+
+async def start_http_server(port: int, host: str = "127.0.0.1"):
+    """Serves registry.render() at /metrics. Returns the runner so the caller can clean it up"""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,86 @@
+import re
+
+TIERS = ("lite", "standard", "strong")
+
+# questions a model can't answer from memory, worth a capable model rather than the lite one
+SEARCH_INTENT = re.compile(
+    r"\b(latest|today|tonight|yesterday|this week|news|current(ly)?|right now|price|score|weather|"
+    r"who won|search|look up|google|released?|update[sd]?)\b",
+    re.IGNORECASE,
+)
+
+BLOCKED_FINISH_REASONS = {"SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "OTHER"}
+
+
+class ModelRouter:
+    """Picks a model tier per request from cheap signals, so short chit-chat goes to a lite model.
+
+    Tiers map to guild settings: lite -> lite_model, standard -> text_model, strong -> strong_model.
+    An unset lite or strong model falls back to text_model, so routing is a no-op until one is configured.
+      - prompts of word_threshold words or more go to strong
+      - attachments, search intent and prompts over lite_max_words go to standard
+      - everything else goes to lite
+    When more than pressure_threshold calls are waiting for a scheduler slot, the tier drops one step"""
+
+    def __init__(self, pressure=lambda kind: 0, pressure_threshold: int = 8):
+        self.pressure = pressure
+        self.pressure_threshold = pressure_threshold
+        self.routed = {tier: 0 for tier in TIERS}
+        self.downgraded = 0
+        self.escalated = 0
+
+    @staticmethod
+    def model(cfg: dict, tier: str) -> str:
+        if tier == "lite":
+            return cfg.get("lite_model") or cfg["text_model"]
+        if tier == "strong":
+            return cfg.get("strong_model") or cfg["text_model"]
+        return cfg["text_model"]
+
+    def route(self, cfg: dict, prompt: str = "", attachment: bool = False, search: bool = False, kind: str = "text"):
+        """(tier, model) for one request"""
+        if not cfg.get("routing"):
+            return "standard", cfg["text_model"]
+
+        words = len((prompt or "").split())
+        if words >= cfg.get("word_threshold", 500):
+            tier = "strong"
+        elif attachment or search or words > cfg.get("lite_max_words", 40) or SEARCH_INTENT.search(prompt or ""):
+            tier = "standard"
+        else:
+            tier = "lite"
+
+        if tier != "lite" and self.pressure(kind) > self.pressure_threshold:
+            tier = TIERS[TIERS.index(tier) - 1]
+            self.downgraded += 1
+
+        self.routed[tier] += 1
+        return tier, self.model(cfg, tier)
+
+    def escalate(self, cfg: dict, tier: str, model: str):
+        """The next tier up with a different model, or None when there is nothing stronger to try"""
+        if not cfg.get("escalate"):
+            return None
+        for stronger in TIERS[TIERS.index(tier) + 1:]:
+            candidate = self.model(cfg, stronger)
+            if candidate != model:
+                self.escalated += 1
+                return stronger, candidate
+        return None
+
+    @staticmethod
+    def unanswered(response) -> bool:
+        """True for a response without text, or one stopped by a safety or recitation filter"""
+        if response is None or not getattr(response, "text", None):
+            return True
+        feedback = getattr(response, "prompt_feedback", None)
+        if feedback is not None and getattr(feedback, "block_reason", None):
+            return True
+        for candidate in getattr(response, "candidates", None) or []:
+            reason = getattr(candidate, "finish_reason", None)
+            if reason is not None and getattr(reason, "name", str(reason)) in BLOCKED_FINISH_REASONS:
+                return True
+        return False
+
+    def stats(self):
+        return {**self.routed, "downgraded": self.downgraded, "escalated": self.escalated}
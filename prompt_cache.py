@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import time
+from abc import ABC, abstractmethod
+
+from lazy_imports import lazy_module
+
+types = lazy_module("google.genai.types")
+
+
+class CachedContentBackend(ABC):
+    """Server-side cached content API. GeminiCachedContentBackend talks to Gemini, tests can swap in a local fake"""
+
+    @abstractmethod
+    async def create(self, model: str, system_instruction: str, ttl: int, display_name: str) -> str:
+        ...
+
+    @abstractmethod
+    async def refresh(self, name: str, ttl: int):
+        ...
+
+    @abstractmethod
+    async def delete(self, name: str):
+        ...
+
+
+class GeminiCachedContentBackend(CachedContentBackend):
+    def __init__(self, get_client):
+        # the genai client is created lazily, resolve it on first use
+        self.get_client = get_client
+
+    async def create(self, model, system_instruction, ttl, display_name):
+        cache = await self.get_client().aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                system_instruction=system_instruction,
+                display_name=display_name,
+                ttl=f"{ttl}s",
+            ),
+        )
+        return cache.name
+
+    async def refresh(self, name, ttl):
+        await self.get_client().aio.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{ttl}s"))
+
+    async def delete(self, name):
+        await self.get_client().aio.caches.delete(name=name)
+
+
+class _Entry:
+    def __init__(self, name, prompt_name, ttl):
+        self.name = name
+        self.prompt_name = prompt_name
+        self.expires_at = time.monotonic() + ttl
+        self.last_used = time.monotonic()
+
+
+class PromptContextCache:
+    """Maps (model, prompt name, content hash) to a server-side cached content entry holding that system prompt.
+
+    Prompts shorter than min_chars are not cached (the API has a minimum token count and short prompts
+    gain nothing). Any backend failure falls back to sending system_instruction as usual."""
+
+    def __init__(self, backend: CachedContentBackend, ttl: int = 3600, refresh_margin: int = 300,
+                 min_chars: int = 8000, failure_backoff: int = 600):
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_chars = min_chars
+        self.failure_backoff = failure_backoff
+        self.entries = {}
+        self.failures = {}
+        self.locks = {}
+        self._maintenance = None
+
+    @staticmethod
+    def key(model: str, prompt_name: str, content: str):
+        return model, prompt_name, hashlib.sha256(content.encode()).hexdigest()
+
+    async def get(self, model: str, prompt_name: str, content: str):
+        """Returns the cached content name to pass as cached_content, or None to send the prompt inline"""
+        if not content or len(content) < self.min_chars:
+            return None
+
+        key = self.key(model, prompt_name, content)
+        if time.monotonic() < self.failures.get(key, 0):
+            return None
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self.entries.get(key)
+            now = time.monotonic()
+            try:
+                if entry is None or entry.expires_at <= now:
+                    name = await self.backend.create(model, content, self.ttl, f"prompt-{prompt_name}")
+                    entry = self.entries[key] = _Entry(name, prompt_name, self.ttl)
+                elif entry.expires_at - now < self.refresh_margin:
+                    await self.backend.refresh(entry.name, self.ttl)
+                    entry.expires_at = now + self.ttl
+            except Exception as e:
+                print(f"Context cache error: {e}")
+                self.entries.pop(key, None)
+                self.failures[key] = now + self.failure_backoff
+                return None
+
+            entry.last_used = now
+            return entry.name
+
+    def invalidate(self, prompt_name: str = None):
+        """Drops (and deletes server side) every entry for prompt_name, or everything"""
+        stale = [key for key, entry in self.entries.items() if prompt_name is None or entry.prompt_name == prompt_name]
+        for key in stale:
+            entry = self.entries.pop(key)
+            self.failures.pop(key, None)
+            self._delete_later(entry.name)
+
+    def _delete_later(self, name):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop (startup/shutdown), the entry simply expires server side
+            return
+        loop.create_task(self._safe_delete(name))
+
+    async def _safe_delete(self, name):
+        try:
+            await self.backend.delete(name)
+        except Exception as e:
+            print(f"Context cache delete error: {e}")
+
+    def start(self, interval: int = 60):
+        if self._maintenance is None or self._maintenance.done():
+            self._maintenance = asyncio.get_running_loop().create_task(self._maintain(interval))
+
+    async def _maintain(self, interval: int):
+        """Refreshes entries in use before they expire and lets idle ones go"""
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for key, entry in list(self.entries.items()):
+                if entry.expires_at - now >= self.refresh_margin + interval:
+                    continue
+                if now - entry.last_used > self.ttl:
+                    self.entries.pop(key, None)
+                    self._delete_later(entry.name)
+                    continue
+                try:
+                    await self.backend.refresh(entry.name, self.ttl)
+                    entry.expires_at = time.monotonic() + self.ttl
+                except Exception as e:
+                    print(f"Context cache refresh error: {e}")
+                    self.entries.pop(key, None)
+
+    async def close(self):
+        if self._maintenance is not None:
+            self._maintenance.cancel()
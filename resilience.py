@@ -0,0 +1,217 @@
+import asyncio
+import random
+import time
+
+# worth another try: timeouts, rate limits and server side errors
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+# transport errors from httpx (genai) and aiohttp, which share no base class worth importing
+TRANSPORT_ERRORS = {
+    "ConnectError", "ConnectTimeout", "ReadError", "ReadTimeout", "WriteError", "PoolTimeout",
+    "RemoteProtocolError", "ServerDisconnectedError", "ClientConnectionError", "ClientOSError",
+}
+
+
+class CircuitOpen(Exception):
+    """The model's circuit is open and there was no fallback to try, the call was not made"""
+
+
+def retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    # genai's errors.APIError carries the HTTP status as .code
+    code = getattr(exc, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_CODES
+    return type(exc).__name__ in TRANSPORT_ERRORS
+
+
+def failure_message(exc: BaseException) -> str:
+    """What the user sees instead of the exception text"""
+    if isinstance(exc, CircuitOpen) or getattr(exc, "code", None) in (429, 503):
+        return "The model is overloaded right now, please try again in a minute."
+    if isinstance(exc, asyncio.TimeoutError):
+        return "The model took too long to answer, please try again."
+    return "Something went wrong while generating a response."
+
+
+class CircuitBreaker:
+    """Opens after `failures` consecutive upstream failures, then lets a single trial call through every reset_seconds"""
+
+    def __init__(self, failures: int = 5, reset_seconds: float = 30.0):
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.count = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_seconds else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def success(self):
+        self.count = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        self.count += 1
+        if self.trial or self.count >= self.failures:
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+    def release(self):
+        """A call that ended without a verdict (cancelled) gives the trial slot back"""
+        self.trial = False
+
+
+class Resilience:
+    """Deadlines, jittered retries, hedging and per-model circuit breakers around Gemini calls.
+
+    call(op, model, attempt, slot) awaits attempt(model) inside slot() (a local concurrency slot, e.g. the
+    scheduler's) under op's deadline, which covers queueing, every retry and hedge. Retryable failures back
+    off with full jitter and count against the model's breaker, unless the call never got past the local
+    queue: running out of time there says nothing about the model. When the breaker is
+    open, or the model keeps failing, the call moves down the model's fallback chain. For ops in hedge_ops,
+    a second identical attempt starts once the first has run longer than hedge_delay(op) (the recent p95),
+    as long as can_hedge(op) says there is spare capacity. The first successful attempt wins"""
+
+    def __init__(self, deadlines: dict, retries: int = 2, base_delay: float = 0.5, max_delay: float = 8.0,
+                 hedge_ops=(), hedge_delay=lambda op: None, can_hedge=lambda op: True,
+                 failures: int = 5, reset_seconds: float = 30.0, fallbacks: dict = None):
+        self.deadlines = deadlines
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_ops = set(hedge_ops)
+        self.hedge_delay = hedge_delay
+        self.can_hedge = can_hedge
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.fallbacks = dict(fallbacks or {})
+        self.breakers = {}
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.fell_back = 0
+        self.short_circuited = 0
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(self.failures, self.reset_seconds)
+        return self.breakers[model]
+
+    def chain(self, model: str):
+        """model followed by its fallbacks, each at most once"""
+        models = [model]
+        while self.fallbacks.get(models[-1]) and self.fallbacks[models[-1]] not in models:
+            models.append(self.fallbacks[models[-1]])
+        return models
+
+    async def call(self, op: str, model: str, attempt, slot=None, deadline: float = None):
+        loop = asyncio.get_running_loop()
+        until = loop.time() + (deadline or self.deadlines.get(op, 60))
+        last_error = None
+
+        for candidate in self.chain(model):
+            breaker = self.breaker(candidate)
+            if not breaker.allow():
+                self.short_circuited += 1
+                continue
+            if candidate != model:
+                self.fell_back += 1
+            try:
+                return await self._retrying(op, candidate, attempt, slot, breaker, until)
+            except Exception as e:
+                if not retryable(e) or loop.time() >= until:
+                    raise
+                last_error = e
+
+        raise last_error or CircuitOpen(f"circuit open for {model}")
+
+    async def _retrying(self, op, model, attempt, slot, breaker: CircuitBreaker, until: float):
+        loop = asyncio.get_running_loop()
+        for n in range(self.retries + 1):
+            remaining = until - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            started = []
+            try:
+                result = await asyncio.wait_for(self._hedged(op, model, attempt, slot, started), remaining)
+            except asyncio.CancelledError:
+                breaker.release()
+                raise
+            except Exception as e:
+                if not started:
+                    # timed out waiting for a local slot, the model was never asked
+                    breaker.release()
+                    raise
+                if not retryable(e):
+                    # the model answered, the request itself was at fault
+                    breaker.success()
+                    raise
+                breaker.failure()
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** n))
+                if n == self.retries or breaker.state != "closed" or loop.time() + delay >= until:
+                    raise
+                self.retried += 1
+                await asyncio.sleep(delay)
+            else:
+                breaker.success()
+                return result
+
+    @staticmethod
+    async def _run(model, attempt, slot, started: list):
+        if slot is None:
+            started.append(model)
+            return await attempt(model)
+        async with slot():
+            started.append(model)
+            return await attempt(model)
+
+    async def _hedged(self, op, model, attempt, slot, started: list):
+        delay = self.hedge_delay(op) if op in self.hedge_ops else None
+        if not delay:
+            return await self._run(model, attempt, slot, started)
+
+        tasks = [asyncio.ensure_future(self._run(model, attempt, slot, started))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self.can_hedge(op):
+                self.hedged += 1
+                tasks.append(asyncio.ensure_future(self._run(model, attempt, slot, started)))
+
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        return {
+            "retried": self.retried,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "fell_back": self.fell_back,
+            "short_circuited": self.short_circuited,
+            "open_circuits": sum(1 for breaker in self.breakers.values() if breaker.state == "open"),
+        }
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt: str) -> str:
+    return re.sub(r"\s+", " ", (prompt or "").strip().lower())
+
+
+def make_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, default=str, ensure_ascii=False).encode()).hexdigest()
+
+
+def context_hash(history, prompt: str, bot_id=None) -> str:
+    """Hash of the channel context. Earlier copies of the same question and the bot's own messages
+    (its answer to them) are left out, otherwise a repeated question would never match the first one"""
+    normalized = normalize_prompt(prompt)
+    lines = [
+        (entry.get("author_id"), normalize_prompt(entry.get("content")))
+        for entry in history
+        if (entry.get("content") or "").strip() and normalize_prompt(entry.get("content")) != normalized
+        and (bot_id is None or entry.get("author_id") != bot_id)
+    ]
+    return make_key(lines)
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class ResponseCache:
+    """TTL/LRU cache of finished Gemini responses with single-flight coalescing of identical in-flight calls.
+    Each feature (text, search, image) opts in separately"""
+
+    def __init__(self, features=(), max_entries: int = 512, ttl: int = 300, shared=None, encode=None, decode=None):
+        self.features = set(features)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # optional second level in a SharedBackend, values go through encode/decode (to and from str)
+        self.shared = shared if encode and decode else None
+        self.encode = encode
+        self.decode = decode
+        self.shared_hits = 0
+
+    def enabled(self, feature: str) -> bool:
+        return feature in self.features
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() > expires_at:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get_or_call(self, feature: str, key: str, factory, cacheable=lambda value: True):
+        """Returns the cached value for key, joins an identical call already in flight, or runs factory()"""
+        if not self.enabled(feature):
+            return await factory()
+
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        flight = self.inflight.get(key)
+        if flight is None:
+            self.misses += 1
+            # the call runs in its own task, so the caller that started it can be cancelled without
+            # taking the result away from the others waiting on it
+            flight = self.inflight[key] = _Flight(asyncio.get_running_loop().create_task(self._fill(key, factory, cacheable)))
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # nobody is left to use the answer
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    async def _fill(self, key: str, factory, cacheable):
+        try:
+            value = await self._shared_get(key)
+            if value is not None:
+                self.shared_hits += 1
+            else:
+                value = await factory()
+                if cacheable(value):
+                    self._shared_put(key, value)
+            if cacheable(value):
+                self.put(key, value)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    async def _shared_get(self, key: str):
+        if not self.shared:
+            return None
+        try:
+            raw = await self.shared.cache_get(f"response:{key}")
+            return self.decode(raw) if raw is not None else None
+        except Exception as e:
+            print(f"Shared cache read error: {e}")
+            return None
+
+    def _shared_put(self, key: str, value):
+        if not self.shared:
+            return
+
+        async def put():
+            try:
+                await self.shared.cache_set(f"response:{key}", self.encode(value), self.ttl)
+            except Exception as e:
+                print(f"Shared cache write error: {e}")
+
+        asyncio.get_running_loop().create_task(put())
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "inflight": len(self.inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "shared_hits": self.shared_hits,
+        }
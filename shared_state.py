@@ -0,0 +1,302 @@
+import asyncio
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shared_cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS shared_cache_expiry ON shared_cache (expires_at);
+"""
+
+
+class SharedBackend(ABC):
+    """State every bot process has to agree on: change events, rate limit buckets and a small TTL cache.
+
+    Events are fire-and-forget notifications ("guild 123 changed"), the data itself stays in storage.
+    A process never receives its own events."""
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.handlers = {}
+
+    def subscribe(self, topic: str, handler):
+        """handler(payload) is called for every event on topic published by another process, sync or async"""
+        self.handlers.setdefault(topic, []).append(handler)
+
+    async def _dispatch(self, topic: str, payload: dict):
+        for handler in self.handlers.get(topic, []):
+            try:
+                result = handler(payload)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"Shared event handler error ({topic}): {e}")
+
+    def publish_nowait(self, topic: str, payload: dict):
+        """publish() from sync code, dropped when there is no running loop (startup scripts, migrations)"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.create_task(self._safe_publish(topic, payload))
+
+    async def _safe_publish(self, topic, payload):
+        try:
+            await self.publish(topic, payload)
+        except Exception as e:
+            print(f"Shared publish error ({topic}): {e}")
+
+    @abstractmethod
+    async def publish(self, topic: str, payload: dict):
+        ...
+
+    @abstractmethod
+    async def take_tokens(self, buckets) -> bool:
+        """buckets: [(key, tokens per second, burst)]. Takes one token from each only if all have one"""
+
+    @abstractmethod
+    async def cache_get(self, key: str):
+        ...
+
+    @abstractmethod
+    async def cache_set(self, key: str, value: str, ttl: float):
+        ...
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SQLiteSharedBackend(SharedBackend):
+    """Local stand-in for a shared server: processes on one machine coordinate through a WAL-mode SQLite file.
+    Events are polled, so delivery lags by up to poll_interval"""
+
+    def __init__(self, path: str = "shared.db", poll_interval: float = 1.0, event_ttl: float = 300):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.event_ttl = event_ttl
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+            # only events published after this process started are of interest
+            self.last_event = self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        self._poller = None
+
+    def _transaction(self, fn):
+        with self.lock:
+            # IMMEDIATE takes the write lock up front so read-modify-write is atomic across processes
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self.conn)
+                self.conn.execute("COMMIT")
+                return result
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    async def publish(self, topic, payload):
+        now = time.time()
+
+        def insert(conn):
+            conn.execute(
+                "INSERT INTO events (topic, payload, origin, created_at) VALUES (?, ?, ?, ?)",
+                (topic, json.dumps(payload), self.origin, now),
+            )
+            conn.execute("DELETE FROM events WHERE created_at < ?", (now - self.event_ttl,))
+
+        await asyncio.to_thread(self._transaction, insert)
+
+    def _fetch_events(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, topic, payload, origin FROM events WHERE id > ? ORDER BY id", (self.last_event,)
+            ).fetchall()
+        if rows:
+            self.last_event = rows[-1][0]
+        return [(topic, json.loads(payload)) for _, topic, payload, origin in rows if origin != self.origin]
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                events = await asyncio.to_thread(self._fetch_events)
+            except Exception as e:
+                print(f"Shared event poll error: {e}")
+                continue
+            for topic, payload in events:
+                await self._dispatch(topic, payload)
+
+    def start(self):
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.get_running_loop().create_task(self._poll())
+
+    async def take_tokens(self, buckets):
+        now = time.time()
+
+        def take(conn):
+            state = []
+            for key, rate, burst in buckets:
+                row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+                state.append((key, tokens))
+            if any(tokens < 1 for _, tokens in state):
+                return False
+            conn.executemany(
+                "INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                [(key, tokens - 1, now) for key, tokens in state],
+            )
+            return True
+
+        return await asyncio.to_thread(self._transaction, take)
+
+    def _cache_get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM shared_cache WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    async def cache_get(self, key):
+        return await asyncio.to_thread(self._cache_get, key)
+
+    async def cache_set(self, key, value, ttl):
+        now = time.time()
+
+        def put(conn):
+            conn.execute(
+                "INSERT INTO shared_cache (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+                (key, value, now + ttl),
+            )
+            conn.execute("DELETE FROM shared_cache WHERE expires_at < ?", (now,))
+
+        await asyncio.to_thread(self._transaction, put)
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+        with self.lock:
+            self.conn.close()
+
+
+class RedisSharedBackend(SharedBackend):
+    """Same contract over Redis, for processes spread across machines. Needs the optional `redis` package"""
+
+    # all-or-nothing token buckets, evaluated atomically server side
+    TAKE_SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local levels = {}
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[i * 2])
+        local burst = tonumber(ARGV[i * 2 + 1])
+        local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+        local tokens = burst
+        if bucket[1] then
+            tokens = math.min(burst, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate)
+        end
+        if tokens < 1 then
+            return 0
+        end
+        levels[i] = tokens
+    end
+    for i, key in ipairs(KEYS) do
+        local rate = tonumber(ARGV[i * 2])
+        local burst = tonumber(ARGV[i * 2 + 1])
+        redis.call('HSET', key, 'tokens', levels[i] - 1, 'updated', now)
+        redis.call('EXPIRE', key, math.ceil(burst / math.max(rate, 0.001)) + 60)
+    end
+    return 1
+    """
+
+    def __init__(self, url: str, channel: str = "bot-events"):
+        super().__init__()
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("SHARED_BACKEND=redis needs the redis package (pip install redis)") from e
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.channel = channel
+        self._take = self.redis.register_script(self.TAKE_SCRIPT)
+        self._listener = None
+
+    async def publish(self, topic, payload):
+        await self.redis.publish(self.channel, json.dumps({"topic": topic, "payload": payload, "origin": self.origin}))
+
+    async def _listen(self):
+        pubsub = self.redis.pubsub()
+        await pubsub.subscribe(self.channel)
+        async for message in pubsub.listen():
+            if message.get("type") != "message":
+                continue
+            event = json.loads(message["data"])
+            if event["origin"] != self.origin:
+                await self._dispatch(event["topic"], event["payload"])
+
+    def start(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+
+    async def take_tokens(self, buckets):
+        keys = [key for key, _, _ in buckets]
+        args = [time.time()]
+        for _, rate, burst in buckets:
+            args += [rate, burst]
+        return bool(await self._take(keys=keys, args=args))
+
+    async def cache_get(self, key):
+        return await self.redis.get(f"cache:{key}")
+
+    async def cache_set(self, key, value, ttl):
+        await self.redis.set(f"cache:{key}", value, ex=max(1, int(ttl)))
+
+    async def close(self):
+        if self._listener is not None:
+            self._listener.cancel()
+        await self.redis.aclose()
+
+
+_backend = None
+_backend_resolved = False
+
+
+def get_shared_backend():
+    """The process-wide SharedBackend selected by SHARED_BACKEND (sqlite or redis), or None for a single process"""
+    global _backend, _backend_resolved
+    if not _backend_resolved:
+        kind = os.getenv("SHARED_BACKEND", "").lower()
+        if kind == "sqlite":
+            _backend = SQLiteSharedBackend(
+                os.getenv("SHARED_SQLITE_PATH", "shared.db"), float(os.getenv("SHARED_POLL_INTERVAL", "1.0"))
+            )
+        elif kind == "redis":
+            _backend = RedisSharedBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+        _backend_resolved = True
+    return _backend
@@ -0,0 +1,269 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id TEXT PRIMARY KEY,
+    config TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS prompts (
+    name TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    created_by TEXT,
+    created_at TEXT,
+    usage_count INTEGER NOT NULL DEFAULT 0,
+    is_active INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS prompts_active ON prompts (is_active);
+CREATE TABLE IF NOT EXISTS prompt_usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    prompt_name TEXT NOT NULL,
+    used_by TEXT,
+    used_at TEXT
+);
+CREATE TABLE IF NOT EXISTS summaries (
+    channel_id TEXT PRIMARY KEY,
+    guild_id TEXT NOT NULL,
+    summary TEXT NOT NULL,
+    last_message_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS summaries_guild ON summaries (guild_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_sessions (
+    thread_id TEXT PRIMARY KEY,
+    updated_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+USAGE_HISTORY_LIMIT = 100
+
+
+class SQLiteStore:
+    """Row-per-guild / row-per-prompt storage so an update only touches what changed"""
+
+    def __init__(self, path: str = "bot.db"):
+        self.path = path
+        # shared between the loop thread and asyncio.to_thread workers, serialized by self.lock
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript(SCHEMA)
+
+    def _write(self, statements):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    # guild config
+
+    def load_guilds(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT guild_id, config FROM guilds").fetchall()
+        return {row["guild_id"]: json.loads(row["config"]) for row in rows}
+
+    def load_guild(self, guild_id):
+        with self.lock:
+            row = self.conn.execute("SELECT config FROM guilds WHERE guild_id = ?", (str(guild_id),)).fetchone()
+        return json.loads(row["config"]) if row else None
+
+    def save_guilds(self, guilds: dict):
+        self._write([
+            ("INSERT INTO guilds (guild_id, config) VALUES (?, ?) "
+             "ON CONFLICT(guild_id) DO UPDATE SET config = excluded.config",
+             (str(gid), json.dumps(cfg)))
+            for gid, cfg in guilds.items()
+        ])
+
+    # channel summaries
+
+    def load_summaries(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM summaries").fetchall()
+        return {
+            row["channel_id"]: {
+                "guild_id": row["guild_id"],
+                "summary": row["summary"],
+                "last_message_id": row["last_message_id"],
+            }
+            for row in rows
+        }
+
+    def save_summaries(self, summaries: dict):
+        self._write([
+            ("INSERT INTO summaries (channel_id, guild_id, summary, last_message_id) VALUES (?, ?, ?, ?) "
+             "ON CONFLICT(channel_id) DO UPDATE SET summary = excluded.summary, "
+             "last_message_id = excluded.last_message_id",
+             (str(cid), entry["guild_id"], entry["summary"], entry["last_message_id"]))
+            for cid, entry in summaries.items()
+        ])
+
+    # prompts
+
+    def load_prompts(self):
+        with self.lock:
+            prompts = self.conn.execute("SELECT * FROM prompts").fetchall()
+            usage = self.conn.execute(
+                "SELECT prompt_name, used_by, used_at FROM prompt_usage ORDER BY id DESC LIMIT ?",
+                (USAGE_HISTORY_LIMIT,)
+            ).fetchall()
+            active = self.conn.execute("SELECT value FROM meta WHERE key = 'active_prompt'").fetchone()
+
+        return {
+            "active_prompt": active["value"] if active else "default",
+            "prompts": {
+                row["name"]: {
+                    "name": row["name"],
+                    "content": row["content"],
+                    "created_by": row["created_by"],
+                    "created_at": row["created_at"],
+                    "usage_count": row["usage_count"],
+                    "is_active": bool(row["is_active"]),
+                }
+                for row in prompts
+            },
+            "usage_history": [dict(row) for row in reversed(usage)],
+        }
+
+    @staticmethod
+    def _prompt_statement(prompt: dict):
+        return (
+            "INSERT INTO prompts (name, content, created_by, created_at, usage_count, is_active) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET content = excluded.content, created_by = excluded.created_by, "
+            "created_at = excluded.created_at, usage_count = excluded.usage_count, is_active = excluded.is_active",
+            (prompt["name"], prompt["content"], prompt["created_by"], prompt["created_at"],
+             prompt["usage_count"], int(prompt["is_active"]))
+        )
+
+    def save_prompt(self, prompt: dict):
+        self._write([self._prompt_statement(prompt)])
+
+    def delete_prompt(self, name: str):
+        self._write([("DELETE FROM prompts WHERE name = ?", (name,))])
+
+    def record_activation(self, active_name: str, prompts: list, usage: dict):
+        self._write([
+            *(self._prompt_statement(prompt) for prompt in prompts),
+            ("INSERT INTO meta (key, value) VALUES ('active_prompt', ?) "
+             "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (active_name,)),
+            ("INSERT INTO prompt_usage (prompt_name, used_by, used_at) VALUES (?, ?, ?)",
+             (usage["prompt_name"], usage["used_by"], usage["used_at"])),
+            ("DELETE FROM prompt_usage WHERE id <= (SELECT MAX(id) FROM prompt_usage) - ?",
+             (USAGE_HISTORY_LIMIT,)),
+        ])
+
+    def replace_prompts(self, data: dict):
+        self._write([
+            ("DELETE FROM prompts", ()),
+            ("DELETE FROM prompt_usage", ()),
+            *(self._prompt_statement(prompt) for prompt in data["prompts"].values()),
+            ("INSERT INTO meta (key, value) VALUES ('active_prompt', ?) "
+             "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (data.get("active_prompt", "default"),)),
+            *(("INSERT INTO prompt_usage (prompt_name, used_by, used_at) VALUES (?, ?, ?)",
+               (u["prompt_name"], u["used_by"], u["used_at"])) for u in data.get("usage_history", [])),
+        ])
+
+    # background jobs, only unfinished ones are kept
+
+    def load_jobs(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM jobs").fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def save_job(self, job: dict):
+        self._write([
+            ("INSERT INTO jobs (id, status, data) VALUES (?, ?, ?) "
+             "ON CONFLICT(id) DO UPDATE SET status = excluded.status, data = excluded.data",
+             (job["id"], job["status"], json.dumps(job)))
+        ])
+
+    def delete_job(self, job_id: str):
+        self._write([("DELETE FROM jobs WHERE id = ?", (job_id,))])
+
+    # per-thread chat sessions
+
+    def load_sessions(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM chat_sessions").fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def save_sessions(self, sessions: list, removed: list = ()):
+        self._write(
+            [("INSERT INTO chat_sessions (thread_id, updated_at, data) VALUES (?, ?, ?) "
+              "ON CONFLICT(thread_id) DO UPDATE SET updated_at = excluded.updated_at, data = excluded.data",
+              (str(session["thread_id"]), session["updated_at"], json.dumps(session))) for session in sessions]
+            + [("DELETE FROM chat_sessions WHERE thread_id = ?", (str(thread_id),)) for thread_id in removed]
+        )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_store = None
+_store_resolved = False
+
+
+def get_store():
+    """Returns the shared SQLiteStore when STORAGE_BACKEND=sqlite, otherwise None (JSON files)"""
+    global _store, _store_resolved
+    if not _store_resolved:
+        if os.getenv("STORAGE_BACKEND", "json").lower() == "sqlite":
+            _store = SQLiteStore(os.getenv("SQLITE_PATH", "bot.db"))
+        _store_resolved = True
+    return _store
+
+
+def migrate_json(store: SQLiteStore, config_path: str = "config.json", prompts_path: str = "prompts.json"):
+    """One-shot import of the legacy JSON files into SQLite"""
+    guilds = prompts = 0
+
+    if os.path.exists(config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        store.save_guilds(data.get("Guilds", {}))
+        store.save_summaries(data.get("Summaries", {}))
+        guilds = len(data.get("Guilds", {}))
+
+    if os.path.exists(prompts_path):
+        with open(prompts_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        store.replace_prompts(data)
+        prompts = len(data.get("prompts", {}))
+
+    return guilds, prompts
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("usage: python storage.py migrate [config.json] [prompts.json]")
+        sys.exit(1)
+
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path='.env')
+
+    store = SQLiteStore(os.getenv("SQLITE_PATH", "bot.db"))
+    guilds, prompts = migrate_json(store, *sys.argv[2:4])
+    store.close()
+    print(f"Migrated {guilds} guild(s) and {prompts} prompt(s) into {store.path}")
@@ -0,0 +1,68 @@
+import asyncio
+from collections import OrderedDict
+
+
+class ChannelSummarizer:
+    """Folds channel history that has scrolled past the raw tail into a running per-channel summary.
+
+    Only channels the bot has answered in are tracked. Every `every` messages a background task
+    summarizes the entries older than the last `tail` messages and stores the result through the
+    DB_Manager, next to the guild config."""
+
+    def __init__(self, summarize, get_db, history_cache, every: int = 20, tail: int = 6, max_channels: int = 500):
+        # summarize(previous_summary, lines, guild_id) -> new summary or None
+        self.summarize = summarize
+        self.get_db = get_db
+        self.history_cache = history_cache
+        self.every = every
+        self.tail = tail
+        self.max_channels = max_channels
+        self.counts: "OrderedDict[int, int]" = OrderedDict()
+        self.tasks = {}
+
+    def context(self, channel_id: int, history):
+        """Returns (summary, raw entries not yet folded into it). Without a summary the history passes through"""
+        db = self.get_db()
+        entry = db.get_summary(channel_id) if db is not None else None
+        if not entry:
+            return None, history
+        return entry["summary"], [e for e in history if e["id"] > entry["last_message_id"]]
+
+    def activate(self, channel_id: int):
+        self.counts.setdefault(channel_id, 0)
+        self.counts.move_to_end(channel_id)
+        while len(self.counts) > self.max_channels:
+            self.counts.popitem(last=False)
+
+    def note(self, message):
+        channel_id = message.channel.id
+        if channel_id not in self.counts:
+            return
+        self.counts[channel_id] += 1
+        if self.counts[channel_id] >= self.every and channel_id not in self.tasks:
+            self.counts[channel_id] = 0
+            task = asyncio.create_task(self.refresh(message.channel, message.guild.id if message.guild else 0))
+            self.tasks[channel_id] = task
+            task.add_done_callback(lambda _: self.tasks.pop(channel_id, None))
+
+    async def refresh(self, channel, guild_id):
+        db = self.get_db()
+        if db is None:
+            return
+        try:
+            previous = db.get_summary(channel.id) or {}
+            last_id = previous.get("last_message_id", 0)
+
+            entries = await self.history_cache.recent(channel, self.history_cache.max_messages)
+            older = entries[:-self.tail] if self.tail else entries
+            new = [e for e in older if e["id"] > last_id and (e.get("content") or "").strip()]
+            if not new:
+                return
+
+            lines = [f"{e['author']}: {e['content']}" for e in new]
+            summary = await self.summarize(previous.get("summary"), lines, guild_id)
+            if summary:
+                await db.set_summary(guild_id, channel.id, summary, new[-1]["id"])
+
+        except Exception as e:
+            print(f"Summary error: {e}")